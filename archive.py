@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Archive of the boards obtained from the API, to study the delays.
+
+Running this file prints the average delay of every line, for each
+hour of the day.
+'''
+
+import datetime
+import fcntl
+import mmap
+import os
+from pathlib import Path
+import struct
+import sys
+import threading
+from time import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from vasttrafik import Accessibility, Board, Event, VehicleType, to_datetime
+
+
+DATADIR = Path(os.environ.get('XDG_DATA_HOME', Path.home() / '.local' / 'share'))
+PATH = DATADIR / 'vasttrafik-cli' / 'archive'
+
+# A departure: line, direction, track and realtime track as indexes in
+# the string table, scheduled and realtime unix times (0 if unknown),
+# index of the vehicle type, flags
+RECORD = struct.Struct('<4I2IBB2x')
+# A board: unix time, stop as index in the string table, index of the
+# first record, number of records
+SNAPSHOT = struct.Struct('<4I')
+
+ACCESSIBLE = 1
+NIGHT = 2
+
+VEHICLE_TYPES = list(VehicleType)
+
+
+class Departure(NamedTuple):
+    time: float
+    stop: str
+    line: str
+    direction: Optional[str]
+    track: Optional[str]
+    rttrack: Optional[str]
+    scheduled: datetime.datetime
+    realtime: Optional[datetime.datetime]
+    vehicle_type: VehicleType
+    accessible: bool
+    night: bool
+
+    @property
+    def delay(self) -> Optional[float]:
+        '''
+        Seconds of delay, None if there is no realtime information
+        '''
+        if self.realtime is None:
+            return None
+        return (self.realtime - self.scheduled).total_seconds()
+
+
+class Delay(NamedTuple):
+    line: str
+    hour: int
+    departures: int
+    # Average, in seconds
+    delay: float
+
+
+def _map(path: Path, size: int) -> memoryview:
+    '''
+    Maps the first size bytes of a file, read only.
+    '''
+    if size == 0:
+        return memoryview(b'')
+    with path.open('rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+
+
+class Archive:
+    '''
+    A directory with 3 files, that are only appended:
+
+    strings: the names of the stops and lines, one per line. Index 0 is
+        None, the first line is index 1.
+    records: the departures, RECORD each.
+    snapshots: one SNAPSHOT for each board, in order of time. It is the
+        index to find the records by time and stop.
+
+    Writers hold a lock on a separate file and write the strings, then
+    the records, then the snapshot. So readers need no lock: they only
+    use what the snapshots refer to.
+
+    It can be used as hook for Vasttrafik, to save all the boards.
+    '''
+
+    def __init__(self, path: Path = PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        # Index 0 is None
+        self._strings: List[str] = ['']
+        self._ids: Dict[str, int] = {}
+        # Bytes of the strings file that were read
+        self._strings_size = 0
+
+    def _load_strings(self) -> None:
+        '''
+        Reads the strings appended since the last call.
+        '''
+        try:
+            with (self.path / 'strings').open('rb') as f:
+                f.seek(self._strings_size)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A string being written has no newline yet
+        data = data[:data.rfind(b'\n') + 1]
+        self._strings_size += len(data)
+        for i in data.decode('utf8').splitlines():
+            self._ids[i] = len(self._strings)
+            self._strings.append(i)
+
+    def _repair(self) -> None:
+        '''
+        Removes what a writer that died left partially written.
+        Must be called with the lock held.
+        '''
+        snapshots = self.path / 'snapshots'
+        size = snapshots.stat().st_size
+        count = size // SNAPSHOT.size
+        end = 0
+        with snapshots.open('r+b') as f:
+            if size != count * SNAPSHOT.size:
+                f.truncate(count * SNAPSHOT.size)
+            if count:
+                f.seek((count - 1) * SNAPSHOT.size)
+                _, _, first, n = SNAPSHOT.unpack(f.read(SNAPSHOT.size))
+                end = first + n
+        with (self.path / 'records').open('r+b') as f:
+            f.truncate(end * RECORD.size)
+        with (self.path / 'strings').open('r+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b'\n') + 1)
+
+    def append(self, stop: str, board: Board) -> None:
+        '''
+        Saves a board of the stop.
+        '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._lock, (self.path / 'lock').open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for name in ('strings', 'records', 'snapshots'):
+                (self.path / name).touch()
+            self._repair()
+            self._load_strings()
+
+            new: List[str] = []
+
+            def sid(s: Optional[str]) -> int:
+                if s is None:
+                    return 0
+                s = ' '.join(s.split())
+                if s not in self._ids:
+                    self._ids[s] = len(self._strings)
+                    self._strings.append(s)
+                    new.append(s)
+                return self._ids[s]
+
+            records = bytearray()
+            for i in board.items:
+                realtime = 0
+                if i._rtdate and i._rttime:
+                    realtime = int(to_datetime(i._rtdate, i._rttime).timestamp())
+                records += RECORD.pack(
+                    sid(i.sname),
+                    sid(i.direction),
+                    sid(i._track),
+                    sid(i._rttrack),
+                    int(to_datetime(i._date, i._time).timestamp()),
+                    realtime,
+                    VEHICLE_TYPES.index(i.vehicle_type),
+                    (ACCESSIBLE if i.accessibility == Accessibility.WHEEL_CHAIR else 0) | (NIGHT if i.night else 0),
+                )
+            stop_id = sid(stop)
+
+            if new:
+                data = ''.join(i + '\n' for i in new).encode('utf8')
+                with (self.path / 'strings').open('ab') as f:
+                    f.write(data)
+                self._strings_size += len(data)
+            with (self.path / 'records').open('ab') as f:
+                first = f.tell() // RECORD.size
+                f.write(records)
+            with (self.path / 'snapshots').open('ab') as f:
+                f.write(SNAPSHOT.pack(int(time()), stop_id, first, len(board.items)))
+
+    def __call__(self, event: Event) -> None:
+        if event.kind == 'board':
+            self.append(event.service, event.data)
+
+    def _snapshots(self, stop: Optional[str], since: Optional[float], until: Optional[float]) -> Iterator[Tuple[int, int, int, int]]:
+        '''
+        Returns the snapshots taken between since and until.
+
+        The snapshots are read before the strings, so the strings
+        they refer to are loaded.
+        '''
+        path = self.path / 'snapshots'
+        try:
+            size = path.stat().st_size // SNAPSHOT.size * SNAPSHOT.size
+        except FileNotFoundError:
+            return
+        snapshots = _map(path, size)
+        with self._lock:
+            self._load_strings()
+        stop_id = None
+        if stop is not None:
+            if stop not in self._ids:
+                return
+            stop_id = self._ids[stop]
+
+        # Binary search of the first snapshot
+        lo, hi = 0, size // SNAPSHOT.size
+        if since is not None:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if SNAPSHOT.unpack_from(snapshots, mid * SNAPSHOT.size)[0] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        for s in SNAPSHOT.iter_unpack(snapshots[lo * SNAPSHOT.size:]):
+            if until is not None and s[0] >= until:
+                break
+            if stop_id is None or s[1] == stop_id:
+                yield s
+
+    def _records(self, stop: Optional[str], since: Optional[float], until: Optional[float]) -> Iterator[Tuple[int, int, Tuple]]:
+        '''
+        Yields the time, the stop and the record of the departures.
+        '''
+        snapshots = list(self._snapshots(stop, since, until))
+        if not snapshots:
+            return
+        size = max(first + count for _, _, first, count in snapshots) * RECORD.size
+        records = _map(self.path / 'records', size)
+        for t, stop_id, first, count in snapshots:
+            for r in RECORD.iter_unpack(records[first * RECORD.size:(first + count) * RECORD.size]):
+                yield t, stop_id, r
+
+    @staticmethod
+    def _interval(since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> Tuple[Optional[float], Optional[float]]:
+        return (
+            since.timestamp() if since is not None else None,
+            until.timestamp() if until is not None else None,
+        )
+
+    def departures(self, stop: Optional[str] = None, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None) -> Iterator[Departure]:
+        '''
+        Yields the departures on the boards of the stop (or of all the
+        stops) saved between since and until.
+        '''
+        strings = self._strings
+        for t, stop_id, r in self._records(stop, *self._interval(since, until)):
+            line, direction, track, rttrack, scheduled, realtime, vehicle_type, flags = r
+            yield Departure(
+                t,
+                strings[stop_id],
+                strings[line],
+                strings[direction] or None,
+                strings[track] or None,
+                strings[rttrack] or None,
+                datetime.datetime.fromtimestamp(scheduled),
+                datetime.datetime.fromtimestamp(realtime) if realtime else None,
+                VEHICLE_TYPES[vehicle_type],
+                bool(flags & ACCESSIBLE),
+                bool(flags & NIGHT),
+            )
+
+    def delays(self, stop: Optional[str] = None, since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None) -> List[Delay]:
+        '''
+        Returns the average delay of every line, for each hour of the
+        day of the scheduled time.
+
+        A departure appears on many boards, the realtime of the last one
+        that had it is used. Departures without realtime are not counted.
+        '''
+        last: Dict[Tuple[int, int, int, int], int] = {}
+        for _, stop_id, r in self._records(stop, *self._interval(since, until)):
+            if r[5]:
+                last[stop_id, r[0], r[1], r[4]] = r[5]
+
+        # Local hour of the unix hours, that the times fall in
+        hours: Dict[int, int] = {}
+        totals: Dict[Tuple[int, int], List[int]] = {}
+        for (_, line, _, scheduled), realtime in last.items():
+            h = scheduled // 3600
+            hour = hours.get(h)
+            if hour is None:
+                hour = hours[h] = datetime.datetime.fromtimestamp(scheduled).hour
+            total = totals.get((line, hour))
+            if total is None:
+                total = totals[line, hour] = [0, 0]
+            total[0] += 1
+            total[1] += realtime - scheduled
+
+        return sorted(
+            Delay(self._strings[line], hour, count, delay / count)
+            for (line, hour), (count, delay) in totals.items()
+        )
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description='Average delay of the lines, for each hour of the day')
+    parser.add_argument('--stop', help='id of the stop')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat, help='date and time, ISO format')
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat, help='date and time, ISO format')
+    parser.add_argument('path', type=Path, nargs='?', default=PATH, help='directory of the archive')
+    args = parser.parse_args()
+
+    delays = Archive(args.path).delays(args.stop, args.since, args.until)
+    width = max([4] + [len(i.line) for i in delays])
+    sys.stdout.write('%-*s %4s %8s %9s\n' % (width, 'Line', 'Hour', 'Count', 'Delay'))
+    for i in delays:
+        sys.stdout.write('%-*s %4d %8d %8.1fm\n' % (width, i.line, i.hour, i.departures, i.delay / 60))
+
+
+if __name__ == '__main__':
+    main()
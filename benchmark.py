@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Benchmarks for vasttrafik-cli.
+
+They run against a local HTTPS server that imitates the Västtrafik API,
+so they need neither network nor an API key.
+
+    ./benchmark.py                       run and print the results
+    ./benchmark.py board trip            only the benchmarks matching
+    ./benchmark.py --save base.json      store the results as baseline
+    ./benchmark.py --compare base.json   fail if slower than the baseline
+    ./benchmark.py --check               only run the correctness checks,
+                                         without the server
+'''
+
+import argparse
+import contextlib
+import datetime
+from functools import partial
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+
+DATE = '2023-03-01'
+LINES = [
+    ('Spårvagn 6', '6', 'TRAM', '#ffffff', '#f28f00', 'Länsmansgården'),
+    ('Spårvagn 7', '7', 'TRAM', '#ffffff', '#7a4e27', 'Tynnered'),
+    ('Buss 16', '16', 'BUS', '#00394d', '#ffffff', 'Eketrägatan'),
+    ('Buss 50', '50', 'BUS', '#ffffff', '#00394d', 'Östra Sjukhuset'),
+    ('Västtågen', 'VÄS', 'VAS', '#ffffff', '#009ddb', 'Trollhättan'),
+    ('Älvsnabben', 'ÄLV', 'BOAT', '#ffffff', '#0098d6', 'Lindholmspiren'),
+]
+
+
+def hhmm(minutes: int) -> str:
+    minutes %= 24 * 60
+    return '%02d:%02d' % (minutes // 60, minutes % 60)
+
+
+def departures(n: int, stop: str = '9021014001760000') -> List[Dict[str, Any]]:
+    r = []
+    for i in range(n):
+        name, sname, type_, fg, bg, direction = LINES[i % len(LINES)]
+        # Different stops at big hubs, so not everything gets grouped
+        stopid = '%s%03d' % (stop[:-3], i // 60 % 20)
+        r.append({
+            'name': name,
+            'sname': sname,
+            'type': type_,
+            'stopid': stopid,
+            'stop': 'Brunnsparken, Göteborg',
+            'time': hhmm(600 + i % 120),
+            'date': DATE,
+            'rtTime': hhmm(601 + i % 120),
+            'rtDate': DATE,
+            'journeyid': str(i),
+            'direction': direction,
+            'track': 'ABCD'[i % 4],
+            'fgColor': fg,
+            'bgColor': bg,
+            'accessibility': 'wheelChair',
+        })
+    return r
+
+
+def leg(i: int, origin: str, destination: str, start: int, end: int) -> Dict[str, Any]:
+    name, sname, type_, fg, bg, direction = LINES[i % len(LINES)]
+    return {
+        'name': name,
+        'sname': sname,
+        'type': type_,
+        'direction': direction,
+        'fgColor': fg,
+        'bgColor': bg,
+        'accessibility': 'wheelChair',
+        'Origin': {'name': origin, 'id': '9021014001760000', 'type': 'ST', 'date': DATE, 'time': hhmm(start), 'track': 'A'},
+        'Destination': {'name': destination, 'id': '9021014001960000', 'type': 'ST', 'date': DATE, 'time': hhmm(end), 'track': 'B'},
+    }
+
+
+def trips(n: int) -> List[Dict[str, Any]]:
+    r: List[Dict[str, Any]] = []
+    for i in range(n):
+        start = 600 + 5 * i
+        if i % 2:
+            r.append({'Leg': leg(i, 'Brunnsparken, Göteborg', 'Chalmers, Göteborg', start, start + 12)})
+        else:
+            r.append({'Leg': [
+                leg(i, 'Brunnsparken, Göteborg', 'Valand, Göteborg', start, start + 4),
+                leg(i + 1, 'Valand, Göteborg', 'Chalmers, Göteborg', start + 6, start + 14),
+            ]})
+    return r
+
+
+def stops(n: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            'id': '90210140%08d' % i,
+            'name': 'Hållplats %d, Göteborg' % i,
+            'lat': '%.6f' % (57.6 + i * 0.001),
+            'lon': '%.6f' % (11.9 + i * 0.001),
+            'idx': str(i),
+        }
+        for i in range(n)
+    ]
+
+
+def gtfs_feed(path: Path, size: int) -> None:
+    '''
+    Writes a GTFS feed of a grid of size x size stations. A line runs
+    along every row and every column, in both directions, every 10
+    minutes from 05:00 to 01:00.
+    '''
+    def csv(*rows: Tuple[Any, ...]) -> str:
+        return ''.join(','.join(map(str, row)) + '\n' for row in rows)
+
+    stations = [(r, c) for r in range(size) for c in range(size)]
+    stop_rows: List[Tuple[Any, ...]] = [('stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'location_type', 'parent_station', 'platform_code')]
+    for r, c in stations:
+        lat, lon = 57.6 + r * 0.005, 11.9 + c * 0.01
+        stop_rows.append((f'S{r}_{c}', f'Hållplats {r}_{c}', lat, lon, 1, '', ''))
+        stop_rows.append((f'S{r}_{c}H', f'Hållplats {r}_{c}', lat, lon, 0, f'S{r}_{c}', 'A'))
+        stop_rows.append((f'S{r}_{c}V', f'Hållplats {r}_{c}', lat, lon, 0, f'S{r}_{c}', 'B'))
+
+    route_rows: List[Tuple[Any, ...]] = [('route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color', 'route_text_color')]
+    trip_rows: List[Tuple[Any, ...]] = [('route_id', 'service_id', 'trip_id', 'trip_headsign', 'wheelchair_accessible')]
+    time_rows: List[Tuple[Any, ...]] = [('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence')]
+    for axis in 'HV':
+        for line in range(size):
+            route = f'{axis}{line}'
+            route_rows.append((route, route, f'Linje {route}', 900 if axis == 'H' else 700, 'f28f00', 'ffffff'))
+            along = [(line, i) if axis == 'H' else (i, line) for i in range(size)]
+            for direction, stations_on in enumerate((along, along[::-1])):
+                for n, start in enumerate(range(5 * 3600, 25 * 3600, 600)):
+                    trip = f'{route}_{direction}_{n}'
+                    r, c = stations_on[-1]
+                    trip_rows.append((route, 'ALL', trip, f'Hållplats {r}_{c}', n % 2))
+                    for i, (r, c) in enumerate(stations_on):
+                        t = start + i * 120
+                        time = '%02d:%02d:%02d' % (t // 3600, t // 60 % 60, t % 60)
+                        time_rows.append((trip, time, time, f'S{r}_{c}{axis}', i + 1))
+
+    with zipfile.ZipFile(path, 'w') as feed:
+        feed.writestr('agency.txt', csv(('agency_id', 'agency_name', 'agency_url', 'agency_timezone'), ('1', 'Benchmark', 'http://localhost', 'Europe/Stockholm')))
+        feed.writestr('stops.txt', csv(*stop_rows))
+        feed.writestr('routes.txt', csv(*route_rows))
+        feed.writestr('trips.txt', csv(*trip_rows))
+        feed.writestr('stop_times.txt', csv(*time_rows))
+        feed.writestr('calendar.txt', csv(
+            ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'),
+            ('ALL', 1, 1, 1, 1, 1, 1, 1, '20230101', '20301231'),
+        ))
+
+
+def payload(service: str, query: Dict[str, str]) -> Any:
+    '''
+    The reply of the fake API.
+
+    The size of the reply is in the request: the stop id for the boards,
+    the origin for the trips and the input for location.
+    '''
+    header = {'serverdate': DATE, 'servertime': '09:58'}
+    if service in ('departureBoard', 'arrivalBoard'):
+        # Real stop ids are long, those get a normal board
+        size = int(query['id'])
+        items = departures(size if size < 1000000 else 40)
+        if service == 'arrivalBoard':
+            return {'ArrivalBoard': dict(header, Arrival=items)}
+        return {'DepartureBoard': dict(header, Departure=items)}
+    if service == 'trip':
+        size = int(query.get('originId', '5'))
+        return {'TripList': dict(header, Trip=trips(size if size < 10000 else 5))}
+    if service == 'location.name':
+        size = sum(c.isdigit() for c in query['input']) and int(''.join(c for c in query['input'] if c.isdigit()))
+        found = stops(size or 10)
+        if 'chalmers' in query['input'].lower():
+            found[0]['name'] = 'Chalmers, Göteborg'
+        elif 'brunnsparken' in query['input'].lower():
+            found[0]['name'] = 'Brunnsparken, Göteborg'
+        return {'LocationList': {'StopLocation': found}}
+    if service == 'location.nearbystops':
+        return {'LocationList': {'StopLocation': stops(int(query.get('maxNo', '10')))}}
+    raise KeyError(service)
+
+
+class FakeAPI(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately, don't wait for the ack
+    disable_nagle_algorithm = True
+    replies: Dict[str, bytes] = {}
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body: bytes, status: int = 200) -> None:
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            encoding = True
+        else:
+            encoding = False
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        u = urlsplit(self.path)
+        if u.geturl() not in self.replies:
+            query = {k: v[0] for k, v in parse_qs(u.query).items()}
+            self.replies[u.geturl()] = json.dumps(payload(u.path.rsplit('/', 1)[-1], query)).encode('utf8')
+        self.reply(self.replies[u.geturl()])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(json.dumps({'expires_in': 3600, 'access_token': 'benchmark'}).encode('ascii'))
+
+
+def start_server(workdir: Path) -> ThreadingHTTPServer:
+    cert = workdir / 'cert.pem'
+    key = workdir / 'key.pem'
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-subj', '/CN=localhost', '-keyout', str(key), '-out', str(cert)],
+        check=True, capture_output=True,
+    )
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAPI)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert), str(key))
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def client_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class Result:
+    def __init__(self, name: str, times: List[float], alloc: int) -> None:
+        self.name = name
+        times = sorted(times)
+        self.p50 = self._percentile(times, 50)
+        self.p90 = self._percentile(times, 90)
+        self.p99 = self._percentile(times, 99)
+        self.alloc = alloc
+
+    @staticmethod
+    def _percentile(times: List[float], p: int) -> float:
+        return times[min(len(times) - 1, len(times) * p // 100)]
+
+    def dump(self) -> Dict[str, float]:
+        return {'p50': self.p50, 'p90': self.p90, 'p99': self.p99, 'alloc': self.alloc}
+
+    def __str__(self) -> str:
+        return '%-36s %10.3f %10.3f %10.3f %10d' % (
+            self.name, self.p50 * 1000, self.p90 * 1000, self.p99 * 1000, self.alloc // 1024)
+
+
+def measure(name: str, f: Callable[[], Any], repeat: int) -> Result:
+    '''
+    Runs f repeat times, after a warm up run that is also used to
+    measure the peak of allocated memory.
+    '''
+    tracemalloc.start()
+    f()
+    alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return Result(name, times, alloc)
+
+
+def setup(workdir: Path, server: ThreadingHTTPServer):
+    '''
+    Prepares the environment for trip.py, and returns a function that
+    creates clients connected to the fake API.
+    '''
+    (workdir / 'config').mkdir()
+    (workdir / 'cache').mkdir()
+    (workdir / 'config' / 'vasttrafik-cli.conf').write_text('key=benchmark\n')
+    os.environ['XDG_CONFIG_HOME'] = str(workdir / 'config')
+    os.environ['XDG_CACHE_HOME'] = str(workdir / 'cache')
+    sys.path.insert(0, str(Path(__file__).parent))
+
+    from vasttrafik import HTTPPool, Vasttrafik
+    tokenfile = workdir / 'token'
+    tokenfile.write_text(json.dumps({'expires_in': int(time.time()) + 3600, 'access_token': 'benchmark'}))
+    api = '127.0.0.1:%d' % server.server_port
+
+    def client(**kwargs) -> Vasttrafik:
+        return Vasttrafik('benchmark', tokenfile, api, transport=HTTPPool(context=client_context()), **kwargs)
+    return client
+
+
+def benchmarks(client) -> Dict[str, Callable[[], Any]]:
+    import vasttrafik
+    from vasttrafik import HTTPPool
+
+    r: Dict[str, Callable[[], Any]] = {}
+    vast = client()
+    fresh = client()
+
+    def new_connection():
+        # A new pool for every request, as it was with urlopen
+        fresh.transport = HTTPPool(context=client_context())
+        return fresh.board('10')
+
+    r['request new connection'] = new_connection
+    r['request pooled connection'] = lambda: vast.board('10')
+    r['location'] = lambda: vast.location('hållplats 10')
+
+    for size in (10, 100, 1000):
+        r[f'board {size}'] = partial(vast.board, str(size))
+    # The same, measured by the hooks
+    measured = client()
+    measured.hooks.append(vasttrafik.Stats())
+    r['board 100 with stats'] = partial(measured.board, '100')
+    for size in (5, 50):
+        r[f'trip {size}'] = partial(vast.trip, originId=str(size), destId='1')
+    # 8 times and 2 via stops
+    r['trip_search 16 queries'] = partial(vast.trip_search, originId='5', destId='1', viaIds=(None, '2'))
+
+    # Grouping of departures, without network
+    for size in (10, 1000, 100000):
+        reply = payload('departureBoard', {'id': str(size)})
+        r[f'parse board {size}'] = partial(vasttrafik.Vasttrafik._parse_board, reply, False)
+
+    # Decoding with and without typedload
+    from typedload import load
+    from typing import List as TList
+    items = payload('departureBoard', {'id': '1000'})['DepartureBoard']['Departure']
+    trip_items = payload('trip', {'originId': '200'})['TripList']['Trip']
+    r['decode board 1000'] = lambda: vasttrafik.load_board_items(items)
+    r['decode board 1000 typedload'] = lambda: load(items, TList[vasttrafik.BoardItem])
+    r['decode trip 200'] = lambda: vasttrafik.load_trips(trip_items)
+    r['decode trip 200 typedload'] = lambda: load(trip_items, vasttrafik.Trips)
+
+    # Queries on the archive
+    from archive import Archive
+    archive = Archive(Path(os.environ['XDG_CACHE_HOME']).parent / 'archive')
+    board_items = vasttrafik.Board(datetime.datetime.now(), vasttrafik.load_board_items(items))
+    for i in range(100):
+        archive.append(str(i % 10), board_items)
+    r['archive delays 100000'] = lambda: Archive(archive.path).delays()
+    r['archive departures 100000'] = lambda: sum(1 for _ in Archive(archive.path).departures())
+
+    # Offline planning
+    from gtfs import Timetable
+    feed = Path(os.environ['XDG_CACHE_HOME']).parent / 'gtfs.zip'
+    gtfs_feed(feed, 20)
+    timetable = Timetable.load_feed(feed)
+    morning = datetime.datetime(2023, 3, 1, 8)
+    r['gtfs trip 20x20'] = partial(timetable.trip, 'S0_0', 'S19_19', morning, 1)
+    r['gtfs trip 20x20 5 trips'] = partial(timetable.trip, 'S0_0', 'S19_19', morning)
+
+    # Rendering
+    servertime, board = vasttrafik.Vasttrafik._parse_board(payload('departureBoard', {'id': '1000'}), False)
+    trip_list = vasttrafik.load_trips(trip_items)
+    r['BoardItem.toTerm 1000'] = lambda: [i.toTerm(servertime) for i in board]
+    r['Trip.toTerm 200'] = lambda: [i.toTerm() for i in trip_list]
+
+    # Whole commands
+    import trip
+
+    def command(f, *argv):
+        trip.vast = vast
+        sys.argv = list(argv)
+        with contextlib.redirect_stdout(io.StringIO()):
+            f()
+
+    r['tripmain'] = lambda: command(trip.tripmain, 'trip', 'brunnsparken', 'chalmers')
+    r['stopsmain'] = lambda: command(trip.stopsmain, 'stops', 'brunnsparken')
+    return r
+
+
+def check_decoders() -> None:
+    '''
+    The fast decoders must give the same result as typedload
+    '''
+    import vasttrafik
+    from typedload import load
+    from typing import List as TList
+
+    items = payload('departureBoard', {'id': '100'})['DepartureBoard']['Departure']
+    items[0]['night'] = 'Y'
+    del items[1]['accessibility']
+    del items[2]['rtTime']
+    assert vasttrafik.load_board_items(items) == load(items, TList[vasttrafik.BoardItem])
+
+    trip_items = payload('trip', {'originId': '10'})['TripList']['Trip']
+    trip_items[1]['Leg']['night'] = True
+    assert vasttrafik.load_trips(trip_items) == load(trip_items, vasttrafik.Trips)
+
+    stop_items = stops(10)
+    del stop_items[0]['idx']
+    assert vasttrafik.load_stops(stop_items) == load(stop_items, vasttrafik.Stops)
+
+
+def check_planner() -> None:
+    '''
+    The trips planned on the GTFS feed of a grid must be the expected
+    ones
+    '''
+    from gtfs import Timetable
+
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = Path(tmp) / 'feed.zip'
+        gtfs_feed(feed, 5)
+        timetable = Timetable.load_feed(feed)
+
+    def legs(origin: str, dest: str, when: datetime.datetime) -> List[Tuple[str, str, str, str, str]]:
+        trips = timetable.trip(origin, dest, when, 1)
+        assert len(trips) == 1
+        return [
+            (i.name, i.Origin.id, i.Origin.datetime_obj.strftime('%d %H:%M'), i.Destination.id, i.Destination.datetime_obj.strftime('%d %H:%M'))
+            for i in trips[0].legs
+        ]
+
+    # Along the first row, change track at the corner, down the last column
+    assert legs('S0_0', 'S4_4', datetime.datetime(2023, 3, 1, 9, 3)) == [
+        ('Linje H0', 'S0_0H', '01 09:10', 'S0_4H', '01 09:18'),
+        ('Gå', 'S0_4H', '01 09:18', 'S0_4V', '01 09:20'),
+        ('Linje V4', 'S0_4V', '01 09:20', 'S4_4V', '01 09:28'),
+    ]
+    # Arriving after midnight
+    assert legs('S0_0', 'S4_4', datetime.datetime(2023, 3, 1, 23, 45)) == [
+        ('Linje H0', 'S0_0H', '01 23:50', 'S0_4H', '01 23:58'),
+        ('Gå', 'S0_4H', '01 23:58', 'S0_4V', '02 00:00'),
+        ('Linje V4', 'S0_4V', '02 00:00', 'S4_4V', '02 00:08'),
+    ]
+    # The trips of the previous day, that run after midnight
+    assert legs('S0_0', 'S2_2', datetime.datetime(2023, 3, 2, 0, 25)) == [
+        ('Linje H0', 'S0_0H', '02 00:30', 'S0_2H', '02 00:34'),
+        ('Gå', 'S0_2H', '02 00:34', 'S0_2V', '02 00:36'),
+        ('Linje V2', 'S0_2V', '02 00:40', 'S2_2V', '02 00:44'),
+    ]
+    # After the last trip, the first one in the morning
+    assert legs('S0_0', 'S0_2', datetime.datetime(2023, 3, 2, 0, 55)) == [
+        ('Linje H0', 'S0_0H', '02 05:00', 'S0_2H', '02 05:04'),
+    ]
+    # Nothing to travel
+    assert timetable.trip('S0_0', 'S0_0', datetime.datetime(2023, 3, 1, 9, 3)) == []
+    assert timetable.trip('S0_0H', 'S0_0', datetime.datetime(2023, 3, 1, 9, 3)) == []
+
+
+# Modules that must not be imported just to start the commands
+SLOW_IMPORTS = (
+    'asyncio',
+    'concurrent.futures',
+    'configobj',
+    'http.client',
+    'sqlite3',
+    'ssl',
+    'typedload',
+    'wcwidth',
+    'xtermcolor',
+)
+
+
+def startup(repeat: int) -> Tuple[Result, List[str]]:
+    '''
+    Measures the time to import trip.py, using -X importtime.
+
+    Returns the result and the slow modules that were imported.
+    '''
+    times = []
+    modules: Set[str] = set()
+    for _ in range(repeat):
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import trip'],
+            cwd=Path(__file__).parent, check=True, capture_output=True, text=True,
+        ).stderr
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            modules.add(name.strip())
+            if name.strip() == 'trip':
+                times.append(int(cumulative) / 1000000)
+    return Result('import trip', times, 0), sorted(modules.intersection(SLOW_IMPORTS))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks for vasttrafik-cli')
+    parser.add_argument('filter', nargs='*', help='Only run the benchmarks containing these words')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs of each benchmark')
+    parser.add_argument('--save', type=Path, help='Save the results in this file')
+    parser.add_argument('--compare', type=Path, help='Compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Maximum slowdown of the median before failing, relative (default: 0.25)')
+    parser.add_argument('--import-budget', type=float, default=100,
+                        help='Maximum time to import trip.py, in milliseconds (default: 100)')
+    parser.add_argument('--check', action='store_true', help='Only run the checks, without the server')
+    args = parser.parse_args()
+
+    if args.check:
+        check_decoders()
+        check_planner()
+        return 0
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        server = start_server(workdir)
+        client = setup(workdir, server)
+        check_decoders()
+        check_planner()
+
+        print('%-36s %10s %10s %10s %10s' % ('', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB'))
+        results = {}
+        for name, f in benchmarks(client).items():
+            if args.filter and not any(i in name for i in args.filter):
+                continue
+            # Big inputs are slow, no need for many runs
+            repeat = args.repeat if '100000' not in name else max(1, args.repeat // 10)
+            result = measure(name, f, repeat)
+            results[name] = result.dump()
+            line = str(result)
+
+            if args.compare:
+                baseline: Optional[Dict[str, float]] = json.loads(args.compare.read_text()).get(name)
+                if baseline is not None:
+                    change = result.p50 / baseline['p50'] - 1
+                    line += ' %+7.1f%%' % (change * 100)
+                    if change > args.threshold:
+                        line += ' REGRESSION'
+                        failed = True
+            print(line)
+        server.shutdown()
+
+        if not args.filter or any(i in 'import trip' for i in args.filter):
+            result, slow = startup(max(1, args.repeat // 4))
+            results[result.name] = result.dump()
+            line = str(result)
+            if result.p50 * 1000 > args.import_budget:
+                line += ' OVER BUDGET'
+                failed = True
+            if slow:
+                line += ' IMPORTS ' + ','.join(slow)
+                failed = True
+            print(line)
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=1))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
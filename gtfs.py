@@ -0,0 +1,607 @@
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Plans the trips without the API, on the timetable of a GTFS feed.
+
+The feed is converted into arrays, that are saved and loaded quickly,
+and searched with RAPTOR (Round-bAsed Public Transit Optimized Router),
+that finds the earliest arrival with one more vehicle at every round.
+'''
+
+from array import array
+import csv
+import datetime
+import io
+import os
+from pathlib import Path
+import pickle
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import zipfile
+
+from vasttrafik import Leg, LegHalf, Stop, Stops, Trip, Trips, VehicleType
+
+
+# Seconds to change between the stops of the same station, when the
+# feed does not say
+CHANGE = 120
+# Maximum number of vehicles in a trip
+ROUNDS = 5
+DAY = 24 * 3600
+INFINITY = 1 << 62
+# Changes when the format of the saved timetable changes
+VERSION = 2
+
+# (arrival time, how the stop was reached). It is reached with
+# None at the origin,
+# ('ride', pattern, trip in the pattern, day offset, boarding position, alighting position)
+# ('walk', from stop, seconds)
+Label = Tuple[int, Optional[tuple]]
+
+
+def vehicle_type(route_type: int) -> VehicleType:
+    '''
+    The vehicle type of a GTFS route_type, basic or extended
+    '''
+    if 1500 <= route_type < 1600 or route_type == 715:
+        return VehicleType.TAXI
+    if route_type in (0, 5, 7) or 900 <= route_type < 1000:
+        return VehicleType.TRAM
+    if route_type == 4 or 1000 <= route_type < 1300:
+        return VehicleType.BOAT
+    if route_type in (1, 2) or 100 <= route_type < 500:
+        return VehicleType.VAS
+    return VehicleType.BUS
+
+
+def seconds(t: str) -> int:
+    '''
+    Converts a GTFS time, that can be over 24:00:00
+    '''
+    h, m, s = t.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def _read(feed: zipfile.ZipFile, name: str) -> Iterator[Dict[str, str]]:
+    '''
+    Rows of a file of the feed. Nothing if the feed does not have it.
+    '''
+    if name not in feed.namelist():
+        return
+    with feed.open(name) as f:
+        yield from csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+
+
+class Timetable:
+    '''
+    The trips running along the same stops, that never overtake each
+    other, form a pattern. The times of a pattern are a matrix, with a
+    row for every trip, sorted by time, and a column for every stop.
+
+    Lists indexed by pattern, stop, trip are arrays, and the lists of
+    lists are stored as one array, with a second one (the *_start) that
+    has the index where the list of every item starts.
+    '''
+
+    def __init__(self) -> None:
+        # Resolved path, size and modification time of the feed it was
+        # read from
+        self.source: Optional[Tuple[str, int, int]] = None
+
+        self.stop_ids: List[str] = []
+        self.stop_names: List[str] = []
+        self.stop_tracks: List[str] = []
+        # Latitude and longitude of every stop
+        self.stop_coords = array('d')
+        self.stop_index: Dict[str, int] = {}
+        self.children: Dict[int, List[int]] = {}
+
+        self.route_names: List[str] = []
+        self.route_snames: List[str] = []
+        self.route_types: List[VehicleType] = []
+        self.route_colors: List[Tuple[str, str]] = []
+
+        self.trip_ids: List[str] = []
+        self.trip_headsigns: List[str] = []
+        self.trip_routes = array('i')
+        self.trip_services = array('i')
+        self.trip_wheelchair = bytearray()
+
+        self.services: List[str] = []
+        # Service: weekdays as bits, first and last day as ordinals
+        self.calendar: Dict[int, Tuple[int, int, int]] = {}
+        # (service, day ordinal): True if added, False if removed
+        self.exceptions: Dict[Tuple[int, int], bool] = {}
+
+        self.pattern_stop_start = array('i', [0])
+        self.pattern_stops = array('i')
+        self.pattern_trip_start = array('i', [0])
+        self.pattern_trips = array('i')
+        # Index in the times of the first trip of the pattern
+        self.pattern_time_start = array('i')
+        self.arrivals = array('i')
+        self.departures = array('i')
+
+        # Patterns stopping at every stop, and the position of the stop
+        self.stop_pattern_start = array('i', [0])
+        self.stop_patterns = array('i')
+        self.stop_positions = array('i')
+
+        # Stops that can be reached walking from every stop
+        self.transfer_start = array('i', [0])
+        self.transfer_stops = array('i')
+        self.transfer_times = array('i')
+
+    @staticmethod
+    def load_feed(path: Path) -> 'Timetable':
+        '''
+        Reads a GTFS feed, the zip file.
+        '''
+        r = Timetable()
+        r.source = Timetable.feed_source(path)
+        with zipfile.ZipFile(path) as feed:
+            r._load_stops(feed)
+            r._load_routes(feed)
+            r._load_calendar(feed)
+            r._load_patterns(feed)
+            r._load_transfers(feed)
+        return r
+
+    def _load_stops(self, feed: zipfile.ZipFile) -> None:
+        parents = []
+        for row in _read(feed, 'stops.txt'):
+            self.stop_index[row['stop_id']] = len(self.stop_ids)
+            self.stop_ids.append(row['stop_id'])
+            self.stop_names.append(row.get('stop_name', ''))
+            self.stop_tracks.append(row.get('platform_code', ''))
+            self.stop_coords.extend((float(row.get('stop_lat') or 0), float(row.get('stop_lon') or 0)))
+            parents.append(row.get('parent_station'))
+        for i, parent in enumerate(parents):
+            if parent in self.stop_index:
+                self.children.setdefault(self.stop_index[parent], []).append(i)
+
+    def _load_routes(self, feed: zipfile.ZipFile) -> None:
+        routes = {}
+        for row in _read(feed, 'routes.txt'):
+            routes[row['route_id']] = len(self.route_names)
+            self.route_snames.append(row.get('route_short_name', ''))
+            self.route_names.append(row.get('route_long_name') or row.get('route_short_name', ''))
+            self.route_types.append(vehicle_type(int(row.get('route_type') or 3)))
+            self.route_colors.append((row.get('route_color', ''), row.get('route_text_color', '')))
+
+        services: Dict[str, int] = {}
+        for row in _read(feed, 'trips.txt'):
+            self.trip_ids.append(row['trip_id'])
+            self.trip_headsigns.append(row.get('trip_headsign', ''))
+            self.trip_routes.append(routes[row['route_id']])
+            service = services.setdefault(row['service_id'], len(services))
+            self.trip_services.append(service)
+            self.trip_wheelchair.append(row.get('wheelchair_accessible') == '1')
+        self.services = list(services)
+
+    def _load_calendar(self, feed: zipfile.ZipFile) -> None:
+        services = {s: i for i, s in enumerate(self.services)}
+        weekdays = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+        def ordinal(date: str) -> int:
+            return datetime.date(int(date[:4]), int(date[4:6]), int(date[6:8])).toordinal()
+
+        for row in _read(feed, 'calendar.txt'):
+            if row['service_id'] not in services:
+                continue
+            mask = sum(1 << i for i, day in enumerate(weekdays) if row[day] == '1')
+            self.calendar[services[row['service_id']]] = (mask, ordinal(row['start_date']), ordinal(row['end_date']))
+        for row in _read(feed, 'calendar_dates.txt'):
+            if row['service_id'] not in services:
+                continue
+            self.exceptions[services[row['service_id']], ordinal(row['date'])] = row['exception_type'] == '1'
+
+    def _load_patterns(self, feed: zipfile.ZipFile) -> None:
+        trips = {t: i for i, t in enumerate(self.trip_ids)}
+
+        # sequence, stop, arrival, departure of every stop of the trips
+        times: Dict[int, array] = {}
+        with feed.open('stop_times.txt') as f:
+            reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+            header = next(reader)
+            trip_col, seq_col, stop_col, arr_col, dep_col = (header.index(i) for i in ('trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time'))
+            for row in reader:
+                trip = trips[row[trip_col]]
+                stop_times = times.get(trip)
+                if stop_times is None:
+                    stop_times = times[trip] = array('i')
+                # Stops without times take the ones of the previous stop
+                arr = row[arr_col] or row[dep_col]
+                dep = row[dep_col] or row[arr_col]
+                stop_times.extend((
+                    int(row[seq_col]),
+                    self.stop_index[row[stop_col]],
+                    seconds(arr) if arr else -1,
+                    seconds(dep) if dep else -1,
+                ))
+
+        groups: Dict[Tuple[int, ...], List[Tuple[List[int], List[int], int]]] = {}
+        for trip, stop_times in times.items():
+            rows = sorted(zip(stop_times[0::4], stop_times[1::4], stop_times[2::4], stop_times[3::4]))
+            arrivals = []
+            departures = []
+            last = 0
+            for _, _, arrival, departure in rows:
+                arrival = arrival if arrival >= 0 else last
+                last = departure if departure >= 0 else arrival
+                arrivals.append(arrival)
+                departures.append(last)
+            groups.setdefault(tuple(i[1] for i in rows), []).append((departures, arrivals, trip))
+        del times
+
+        stop_patterns: List[List[Tuple[int, int]]] = [[] for _ in self.stop_ids]
+        for stops, group in groups.items():
+            group.sort()
+            # Trips that overtake others go to another pattern
+            lanes: List[List[Tuple[List[int], List[int], int]]] = []
+            for t in group:
+                for lane in lanes:
+                    d, a, _ = lane[-1]
+                    if all(i >= j for i, j in zip(t[0], d)) and all(i >= j for i, j in zip(t[1], a)):
+                        lane.append(t)
+                        break
+                else:
+                    lanes.append([t])
+
+            for lane in lanes:
+                pattern = len(self.pattern_time_start)
+                for position, stop in enumerate(stops):
+                    stop_patterns[stop].append((pattern, position))
+                self.pattern_stops.extend(stops)
+                self.pattern_stop_start.append(len(self.pattern_stops))
+                self.pattern_time_start.append(len(self.departures))
+                for departures, arrivals, trip in lane:
+                    self.pattern_trips.append(trip)
+                    self.departures.extend(departures)
+                    self.arrivals.extend(arrivals)
+                self.pattern_trip_start.append(len(self.pattern_trips))
+
+        for patterns in stop_patterns:
+            for pattern, position in patterns:
+                self.stop_patterns.append(pattern)
+                self.stop_positions.append(position)
+            self.stop_pattern_start.append(len(self.stop_patterns))
+
+    def _load_transfers(self, feed: zipfile.ZipFile) -> None:
+        transfers: Dict[Tuple[int, int], int] = {}
+        for children in self.children.values():
+            for i in children:
+                for j in children:
+                    if i != j:
+                        transfers[i, j] = CHANGE
+        for row in _read(feed, 'transfers.txt'):
+            from_stop = self.stop_index.get(row['from_stop_id'])
+            to_stop = self.stop_index.get(row['to_stop_id'])
+            if from_stop is None or to_stop is None or from_stop == to_stop:
+                continue
+            if row.get('transfer_type') == '3':
+                transfers.pop((from_stop, to_stop), None)
+            else:
+                transfers[from_stop, to_stop] = int(row.get('min_transfer_time') or CHANGE)
+
+        by_stop: List[List[Tuple[int, int]]] = [[] for _ in self.stop_ids]
+        for (from_stop, to_stop), time in transfers.items():
+            by_stop[from_stop].append((to_stop, time))
+        for stop_transfers in by_stop:
+            for to_stop, time in stop_transfers:
+                self.transfer_stops.append(to_stop)
+                self.transfer_times.append(time)
+            self.transfer_start.append(len(self.transfer_stops))
+
+    @staticmethod
+    def load(path: Path) -> 'Timetable':
+        '''
+        Loads a timetable saved with save()
+        '''
+        with path.open('rb') as f:
+            version, data = pickle.load(f)
+        if version != VERSION:
+            raise Exception(f'Unsupported timetable version: {version}')
+        r = Timetable()
+        r.__dict__.update(data)
+        return r
+
+    def save(self, path: Path) -> None:
+        tmp = path.with_name(path.name + '.%d' % os.getpid())
+        with tmp.open('wb') as f:
+            pickle.dump((VERSION, self.__dict__), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def feed_source(feed: Path) -> Tuple[str, int, int]:
+        '''
+        Identifies the feed, to know if a saved timetable comes from it
+        '''
+        stat = feed.stat()
+        return str(feed.resolve()), stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def open(feed: Path, cache: Path) -> 'Timetable':
+        '''
+        Loads the timetable saved in cache, if it was read from the same
+        feed, otherwise reads the feed and saves it there.
+        '''
+        try:
+            r = Timetable.load(cache)
+            if r.source == Timetable.feed_source(feed):
+                return r
+        except Exception:
+            pass
+        r = Timetable.load_feed(feed)
+        r.save(cache)
+        return r
+
+    def stops(self) -> Stops:
+        '''
+        The stations, and the stops that are not part of one
+        '''
+        children = {i for c in self.children.values() for i in c}
+        return [
+            Stop(id, self.stop_coords[2 * i + 1], self.stop_coords[2 * i], self.stop_names[i])
+            for i, id in enumerate(self.stop_ids)
+            if i not in children
+        ]
+
+    def active(self, date: datetime.date) -> bytearray:
+        '''
+        For every service, 1 if it runs on that day
+        '''
+        day = date.toordinal()
+        weekday = 1 << date.weekday()
+        r = bytearray(len(self.services))
+        for service, (mask, first, last) in self.calendar.items():
+            r[service] = bool(mask & weekday) and first <= day <= last
+        for (service, d), added in self.exceptions.items():
+            if d == day:
+                r[service] = added
+        return r
+
+    def _stops(self, id: str) -> List[int]:
+        '''
+        The stop and, if it is a station, its stops
+        '''
+        if id not in self.stop_index:
+            raise Exception(f'Unknown stop: {id}')
+        stop = self.stop_index[id]
+        return [stop] + self.children.get(stop, [])
+
+    def _earliest(self, pattern: int, position: int, time: int, days: List[Tuple[int, bytearray]]) -> Optional[Tuple[int, int, int]]:
+        '''
+        The first trip of the pattern that running on one of the days
+        leaves the stop at the position at time or later. The days must
+        be sorted.
+
+        Returns the trip in the pattern, the offset of its day and the
+        departure.
+        '''
+        width = self.pattern_stop_start[pattern + 1] - self.pattern_stop_start[pattern]
+        first_trip = self.pattern_trip_start[pattern]
+        count = self.pattern_trip_start[pattern + 1] - first_trip
+        base = self.pattern_time_start[pattern] + position
+        departures = self.departures
+        services = self.trip_services
+        trips = self.pattern_trips
+
+        best = None
+        for offset, active in days:
+            target = time - offset
+            if departures[base + (count - 1) * width] < target:
+                # All the trips of the day left already
+                continue
+            if best is not None and departures[base] + offset >= best[2]:
+                # The following days can't have earlier trips
+                break
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if departures[base + mid * width] < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < count and not active[services[trips[first_trip + lo]]]:
+                lo += 1
+            if lo < count:
+                departure = departures[base + lo * width] + offset
+                if best is None or departure < best[2]:
+                    best = (lo, offset, departure)
+        return best
+
+    def _search(self, origins: List[int], targets: Set[int], start: int, days: List[Tuple[int, bytearray]]) -> List[List[tuple]]:
+        '''
+        The journeys that arrive earliest with 1, 2… vehicles, each
+        arriving before the ones with less vehicles.
+
+        Times are seconds after the midnight of the day of the search.
+        A journey is a list of ('ride', pattern, trip, offset, boarding,
+        alighting) or ('walk', from stop, to stop, departure, arrival).
+        '''
+        arrival: List[Dict[int, Label]] = [{i: (start, None) for i in origins}]
+        # The stops reached by a vehicle, where a walk can start
+        rode: List[Dict[int, Label]] = [dict(arrival[0])]
+        best = {i: start for i in origins}
+        best_target = INFINITY
+        if targets.intersection(origins):
+            return []
+        journeys = []
+        stops = self.pattern_stops
+        arrivals = self.arrivals
+        departures = self.departures
+
+        for k in range(ROUNDS + 1):
+            if k:
+                # Patterns to scan, from the first marked stop
+                queue: Dict[int, int] = {}
+                for stop in arrival[-1]:
+                    for i in range(self.stop_pattern_start[stop], self.stop_pattern_start[stop + 1]):
+                        pattern = self.stop_patterns[i]
+                        position = self.stop_positions[i]
+                        if queue.get(pattern, position + 1) > position:
+                            queue[pattern] = position
+
+                previous = arrival[-1]
+                current: Dict[int, Label] = {}
+                rode_now: Dict[int, Label] = {}
+                for pattern, first in queue.items():
+                    offset_stops = self.pattern_stop_start[pattern]
+                    width = self.pattern_stop_start[pattern + 1] - offset_stops
+                    times = self.pattern_time_start[pattern]
+                    trip: Optional[Tuple[int, int, int]] = None
+                    row = 0
+                    for position in range(first, width):
+                        stop = stops[offset_stops + position]
+                        if trip is not None:
+                            time = arrivals[row + position] + trip[1]
+                            if time < best.get(stop, INFINITY) and time < best_target:
+                                best[stop] = time
+                                rode_now[stop] = current[stop] = (time, ('ride', pattern, trip[0], trip[1], trip[2], position))
+                                if stop in targets:
+                                    best_target = time
+                        reached = previous.get(stop)
+                        if reached is not None and (trip is None or reached[0] <= departures[row + position] + trip[1]):
+                            found = self._earliest(pattern, position, reached[0], days)
+                            if found is not None and (trip is None or found[2] < departures[row + position] + trip[1]):
+                                trip = (found[0], found[1], position)
+                                row = times + found[0] * width
+                arrival.append(current)
+                rode.append(rode_now)
+
+            # Walks, from where a vehicle arrived
+            current = arrival[-1]
+            for stop, (time, _) in list(rode[-1].items()):
+                for i in range(self.transfer_start[stop], self.transfer_start[stop + 1]):
+                    to_stop = self.transfer_stops[i]
+                    walked = time + self.transfer_times[i]
+                    if walked < best.get(to_stop, INFINITY) and walked < best_target:
+                        best[to_stop] = walked
+                        current[to_stop] = (walked, ('walk', stop, self.transfer_times[i]))
+                        if to_stop in targets:
+                            best_target = walked
+
+            arrived = [i for i in targets if i in current]
+            if arrived:
+                journeys.append(self._journey(arrival, rode, min(arrived, key=lambda i: current[i][0])))
+            if not current:
+                break
+        return journeys
+
+    def _journey(self, arrival: List[Dict[int, Label]], rode: List[Dict[int, Label]], stop: int) -> List[tuple]:
+        '''
+        Follows the labels back from the stop to the origin.
+        '''
+        k = len(arrival) - 1
+        r = []
+        time, label = arrival[k][stop]
+        while label is not None:
+            if label[0] == 'walk':
+                _, from_stop, walk = label
+                r.append(('walk', from_stop, stop, time - walk, time))
+                stop = from_stop
+                time, label = rode[k][stop]
+            else:
+                r.append(label)
+                stop = self.pattern_stops[self.pattern_stop_start[label[1]] + label[4]]
+                k -= 1
+                time, label = arrival[k][stop]
+        r.reverse()
+        return r
+
+    def _departure(self, step: tuple) -> int:
+        if step[0] == 'walk':
+            return step[3]
+        _, pattern, trip, offset, boarding, _ = step
+        width = self.pattern_stop_start[pattern + 1] - self.pattern_stop_start[pattern]
+        return self.departures[self.pattern_time_start[pattern] + trip * width + boarding] + offset
+
+    def _half(self, stop: int, time: int, midnight: datetime.datetime) -> LegHalf:
+        when = midnight + datetime.timedelta(seconds=time)
+        return LegHalf(
+            date=when.strftime('%Y-%m-%d'),
+            id=self.stop_ids[stop],
+            name=self.stop_names[stop],
+            time=when.strftime('%H:%M'),
+            type='ST',
+            track=self.stop_tracks[stop],
+        )
+
+    def _leg(self, step: tuple, midnight: datetime.datetime) -> Leg:
+        if step[0] == 'walk':
+            _, from_stop, to_stop, departure, arrival = step
+            return Leg(
+                name='Gå',
+                type=VehicleType.WALK,
+                Origin=self._half(from_stop, departure, midnight),
+                Destination=self._half(to_stop, arrival, midnight),
+            )
+
+        _, pattern, trip, offset, boarding, alighting = step
+        stops = self.pattern_stop_start[pattern]
+        row = self.pattern_time_start[pattern] + trip * (self.pattern_stop_start[pattern + 1] - stops)
+        trip = self.pattern_trips[self.pattern_trip_start[pattern] + trip]
+        route = self.trip_routes[trip]
+        colors: Dict[str, Any] = {}
+        bg, fg = self.route_colors[route]
+        if bg:
+            colors['bgColor'] = '#' + bg
+        if fg:
+            colors['fgColor'] = '#' + fg
+        return Leg(
+            name=self.route_names[route],
+            type=self.route_types[route],
+            Origin=self._half(self.pattern_stops[stops + boarding], self.departures[row + boarding] + offset, midnight),
+            Destination=self._half(self.pattern_stops[stops + alighting], self.arrivals[row + alighting] + offset, midnight),
+            accessibility='wheelChair' if self.trip_wheelchair[trip] else '',
+            sname=self.route_snames[route] or None,
+            direction=self.trip_headsigns[trip] or None,
+            id=self.trip_ids[trip],
+            **colors,
+        )
+
+    def trip(self, originId: str, destId: str, datetime_obj: Optional[datetime.datetime] = None, count: int = 5) -> Trips:
+        '''
+        Returns up to count trips between two stops, leaving from
+        datetime_obj (default now), like Vasttrafik.trip().
+
+        The ids are the stop_id of the feed. A station includes its
+        stops.
+        '''
+        if datetime_obj is None:
+            datetime_obj = datetime.datetime.now()
+        origins = self._stops(originId)
+        targets = set(self._stops(destId))
+
+        midnight = datetime.datetime.combine(datetime_obj.date(), datetime.time())
+        days = [(offset * DAY, self.active(datetime_obj.date() + datetime.timedelta(days=offset))) for offset in (-1, 0, 1)]
+        start = int((datetime_obj - midnight).total_seconds())
+
+        # Searches again after the first departure, for the next trips
+        found: Dict[tuple, Trip] = {}
+        time = start
+        while len(found) < count and time < start + DAY:
+            journeys = self._search(origins, targets, time, days)
+            if not journeys:
+                break
+            for journey in journeys:
+                trip = Trip([self._leg(i, midnight) for i in journey])
+                found.setdefault(trip.key, trip)
+            time = max(time, min(self._departure(i[0]) for i in journeys)) + 60
+        return sorted(found.values(), key=lambda i: (i.departure, i.arrival))[:count]
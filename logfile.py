@@ -0,0 +1,84 @@
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Files of lines that several processes append to, such as the recent
+stops and the history of the requests.
+'''
+
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+
+
+T = TypeVar('T')
+
+
+class LogFile:
+    '''
+    A file that is only appended or replaced atomically, so readers
+    need no lock.
+
+    Writers hold the lock, on a separate file.
+    '''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def read(self, parse: Callable[[str], T]) -> Iterator[T]:
+        '''
+        Yields the lines parsed, skipping the ones that parse refuses
+        with ValueError.
+        '''
+        try:
+            with self.path.open('rt', encoding='utf8') as f:
+                for line in f:
+                    try:
+                        yield parse(line)
+                    except ValueError:
+                        # A line being written, or damaged
+                        continue
+        except OSError:
+            pass
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with self.path.with_name(self.path.name + '.lock').open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def append(self, line: str) -> int:
+        '''
+        Appends a line, returns the new size of the file. Must be called
+        with the lock held.
+        '''
+        with self.path.open('at', encoding='utf8') as f:
+            f.write(line)
+            return f.tell()
+
+    def replace(self, lines: Iterable[str]) -> None:
+        '''
+        Rewrites the file with the lines. Must be called with the lock
+        held.
+        '''
+        tmp = self.path.with_name('%s.%d' % (self.path.name, os.getpid()))
+        with tmp.open('wt', encoding='utf8') as f:
+            f.write(''.join(lines))
+        os.replace(tmp, self.path)
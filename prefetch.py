@@ -0,0 +1,118 @@
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Requests in advance the boards and trips that are usually needed at
+this time of the day, so that the commands find them in the cache.
+'''
+
+import datetime
+from pathlib import Path
+from time import time
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from logfile import LogFile
+from vasttrafik import Vasttrafik
+
+
+class Use(NamedTuple):
+    '''
+    A board or a trip that was requested. ids has the stop for a board,
+    the origin and destination for a trip.
+    '''
+    time: float
+    kind: str
+    ids: Tuple[str, ...]
+
+    def line(self) -> str:
+        return '%.0f\t%s\t%s\n' % (self.time, self.kind, '\t'.join(self.ids))
+
+    @staticmethod
+    def parse(line: str) -> 'Use':
+        time, kind, *ids = line.rstrip('\n').split('\t')
+        if kind not in {'board', 'trip'} or len(ids) != (1 if kind == 'board' else 2):
+            raise ValueError(f'Invalid line: {line}')
+        return Use(float(time), kind, tuple(ids))
+
+
+class History:
+    '''
+    Log of the boards and trips requested, a LogFile with one line for
+    each.
+
+    Once the file grows over compact_size bytes, it is rewritten without
+    the uses older than max_age seconds.
+    '''
+
+    def __init__(self, path: Path, max_age: int = 28 * 24 * 3600, compact_size: int = 65536) -> None:
+        self.path = path
+        self.log = LogFile(path)
+        self.max_age = max_age
+        self.compact_size = compact_size
+
+    def read(self) -> List[Use]:
+        return list(self.log.read(Use.parse))
+
+    def add(self, kind: str, ids: Tuple[str, ...]) -> None:
+        with self.log.lock():
+            if self.log.append(Use(time(), kind, ids).line()) > self.compact_size:
+                self.compact()
+
+    def compact(self) -> None:
+        '''
+        Removes the old uses. Must be called with the lock held.
+        '''
+        oldest = time() - self.max_age
+        self.log.replace(i.line() for i in self.read() if i.time >= oldest)
+
+    def due(self, now: datetime.datetime, lead: int = 600, min_days: int = 2) -> List[Tuple[str, Tuple[str, ...]]]:
+        '''
+        Returns the (kind, ids) that on at least min_days days were used
+        within lead seconds after the current time of the day.
+
+        Working days and weekends are counted separately.
+        '''
+        weekend = now.weekday() >= 5
+        oldest = now.timestamp() - self.max_age
+        minute = now.hour * 60 + now.minute
+        days: Dict[Tuple[str, Tuple[str, ...]], Set[datetime.date]] = {}
+        for use in self.read():
+            if use.time < oldest:
+                continue
+            when = datetime.datetime.fromtimestamp(use.time)
+            if (when.weekday() >= 5) != weekend:
+                continue
+            if (when.hour * 60 + when.minute - minute) % 1440 <= lead // 60:
+                days.setdefault((use.kind, use.ids), set()).add(when.date())
+        return [key for key, d in days.items() if len(d) >= min_days]
+
+
+def prefetch(vast: Vasttrafik, history: History, now: datetime.datetime, time_span=None, departures=2) -> int:
+    '''
+    Refreshes in the cache of vast the boards and trips that are due.
+    time_span and departures must be the same used later for the boards.
+
+    Returns how many requests failed.
+    '''
+    due = history.due(now)
+    return vast.prefetch(
+        boards=[ids[0] for kind, ids in due if kind == 'board'],
+        trips=[(ids[0], ids[1]) for kind, ids in due if kind == 'trip'],
+        time_span=time_span,
+        departures=departures,
+    )
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+The stops used recently, for the completion and to find the stops
+given on the command line without querying the API.
+
+Running this file prints the completions for a prefix, the bash
+completion scripts call it.
+'''
+
+import os
+from pathlib import Path
+import sys
+from time import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+from logfile import LogFile
+
+# Not imported when running the completion
+if TYPE_CHECKING:
+    from vasttrafik import Stop
+
+
+CACHEDIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+PATH = CACHEDIR / 'vasttrafik-cli-recent'
+# Written by the older versions, only the words for the completion
+OLD_PATH = CACHEDIR / 'vasttrafik-cli-stops'
+
+# After this many seconds, a use counts half
+HALF_LIFE = 30 * 24 * 3600
+
+
+def decay(seconds: float) -> float:
+    return 0.5 ** (max(seconds, 0) / HALF_LIFE)
+
+
+def word(name: str) -> str:
+    '''
+    The part of the name that the completion can handle: lower case,
+    up to the first space or comma.
+    '''
+    for char in ' ,':
+        name = name.split(char, 1)[0]
+    return name.lower()
+
+
+def normalize(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+
+class Entry(NamedTuple):
+    '''
+    A stop and what was typed to find it, with its score at the time
+    it was last used. Every use adds 1 to the score, and it halves
+    every HALF_LIFE.
+
+    The words imported from OLD_PATH have no id, they are only used
+    for the completion.
+    '''
+    score: float
+    time: float
+    id: str
+    lat: float
+    lon: float
+    name: str
+    query: str = ''
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.id, self.query
+
+    def rank(self, now: float) -> float:
+        return self.score * decay(now - self.time)
+
+    def merge(self, o: 'Entry') -> 'Entry':
+        '''
+        Combines two entries of the same stop and query
+        '''
+        latest = max(self, o, key=lambda i: i.time)
+        return latest._replace(score=self.rank(latest.time) + o.rank(latest.time))
+
+    def line(self) -> str:
+        name = ' '.join(self.name.split())
+        return f'{self.score:.6g}\t{self.time:.0f}\t{self.id}\t{self.lat}\t{self.lon}\t{name}\t{self.query}\n'
+
+    @staticmethod
+    def parse(line: str) -> 'Entry':
+        fields = line.rstrip('\n').split('\t')
+        # Lines written before the query was stored have no query
+        score, time, id, lat, lon, name = fields[:6]
+        query = fields[6] if len(fields) > 6 else ''
+        return Entry(float(score), float(time), id, float(lat), float(lon), name, query)
+
+
+class RecentStops:
+    '''
+    The file is a LogFile, every use of a stop appends a line. Once it
+    grows over compact_size bytes, it is rewritten with one line per
+    stop, keeping the max_entries best ranked.
+
+    If the file doesn't exist yet, it is created with the words of
+    old_path, the completions saved by the older versions.
+    '''
+
+    def __init__(self, path: Path = PATH, max_entries: int = 100, compact_size: int = 16384, old_path: Optional[Path] = OLD_PATH) -> None:
+        self.path = path
+        self.log = LogFile(path)
+        self.max_entries = max_entries
+        self.compact_size = compact_size
+        self.old_path = old_path
+        self._entries: Optional[Dict[Tuple[str, str], Entry]] = None
+
+    def _migrate(self) -> None:
+        '''
+        Creates the file from the words in old_path, the oldest
+        ranked last.
+        '''
+        if self.old_path is None or self.path.exists():
+            return
+        try:
+            with self.old_path.open('rt', encoding='utf8') as f:
+                words = [i.strip() for i in f if i.strip()]
+            mtime = self.old_path.stat().st_mtime
+        except (OSError, ValueError):
+            return
+        with self.log.lock():
+            if self.path.exists():
+                return
+            entries = [Entry(1, mtime - len(words) + i, '', 0, 0, w, normalize(w)) for i, w in enumerate(words)]
+            self.log.replace(i.line() for i in entries)
+
+    def _read(self) -> Dict[Tuple[str, str], Entry]:
+        entries: Dict[Tuple[str, str], Entry] = {}
+        try:
+            self._migrate()
+        except OSError:
+            pass
+        for entry in self.log.read(Entry.parse):
+            if entry.key in entries:
+                entry = entries[entry.key].merge(entry)
+            entries[entry.key] = entry
+        return entries
+
+    @property
+    def entries(self) -> Dict[Tuple[str, str], Entry]:
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def ranked(self) -> List[Entry]:
+        now = time()
+        return sorted(self.entries.values(), key=lambda i: -i.rank(now))
+
+    def add(self, stop: 'Stop', query: str = '') -> None:
+        '''
+        Records a use of the stop, found by typing query.
+        '''
+        entry = Entry(1, time(), stop.id, stop.lat, stop.lon, stop.name, normalize(query))
+        with self.log.lock():
+            if self.log.append(entry.line()) > self.compact_size:
+                self._entries = None
+                self.compact()
+                return
+        if self._entries is not None:
+            old = self._entries.get(entry.key)
+            self._entries[entry.key] = old.merge(entry) if old else entry
+
+    def compact(self) -> None:
+        '''
+        Rewrites the file with one line per stop. Must be called with the
+        lock held.
+        '''
+        entries = self.ranked()[:self.max_entries]
+        self.log.replace(i.line() for i in entries)
+        self._entries = {i.key: i for i in entries}
+
+    def complete(self, prefix: str = '') -> List[str]:
+        '''
+        Returns the words starting with prefix, best ranked first.
+        '''
+        prefix = prefix.lower()
+        words = (word(i.name) for i in self.ranked())
+        return list(dict.fromkeys(i for i in words if i.startswith(prefix)))
+
+    def find(self, query: str) -> Optional['Stop']:
+        '''
+        Returns the best ranked stop that was found by typing the same
+        query, or whose name is the query.
+        '''
+        query = normalize(query)
+        for i in self.ranked():
+            if i.id and (i.query == query or normalize(i.name) == query):
+                from vasttrafik import Stop
+                return Stop(i.id, i.lon, i.lat, i.name, None)
+        return None
+
+
+if __name__ == '__main__':
+    sys.stdout.write(''.join(i + '\n' for i in RecentStops().complete(sys.argv[1] if len(sys.argv) > 1 else '')))
@@ -0,0 +1,312 @@
+# vasttrafik-cli
+# Copyright (C) 2012-2023 Salvo "LtWorf" Tomaselli
+#
+# vasttrafik-cli is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
+
+'''
+Local database of stops, to find them without querying the API.
+'''
+
+from bisect import bisect_left
+import csv
+import json
+import math
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from vasttrafik import Stop, Stops, load_stops
+
+
+# Size of the cells of the spatial grid, in degrees. About 1km.
+CELL = 0.01
+
+
+def normalize(name: str) -> str:
+    return ' '.join(name.lower().replace(',', ' ').split())
+
+
+def trigrams(name: str) -> Set[str]:
+    name = f'  {name} '
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    '''
+    Distance in meters between two coordinates
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 12742000 * math.asin(math.sqrt(a))
+
+
+class StopIndex:
+    '''
+    Stops collected from the replies of the API or imported from a file.
+
+    Names are indexed by the prefix of every word and by trigrams, the
+    coordinates on a grid.
+
+    If path is given, the stops saved there are loaded on first use.
+    '''
+
+    def __init__(self, stops: Iterable[Stop] = (), path: Optional[Path] = None) -> None:
+        self.stops: Dict[str, Stop] = {}
+        # Sorted list of (name from the start of a word, id)
+        self._prefixes: List[Tuple[str, str]] = []
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._grid: Dict[Tuple[int, int], List[Stop]] = {}
+        # Minimum and maximum cell coordinates in the grid
+        self._bounds = (0, 0, 0, 0)
+        self._modified = False
+        # Ids of the stops added with save=False, that are not saved
+        self._unsaved: Set[str] = set()
+        self._path = path
+        # Stops added before loading, and if they need to be saved
+        self._pending: List[Tuple[Stops, bool]] = []
+        self.add(stops)
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self.stops)
+
+    @property
+    def modified(self) -> bool:
+        '''
+        True if there are stops that have not been saved
+        '''
+        if any(save for _, save in self._pending):
+            self._load()
+        return self._modified
+
+    def _load(self) -> None:
+        '''
+        Loads the stops from the file, if it wasn't done yet, and then
+        adds the pending ones.
+        '''
+        if self._path is None:
+            return
+        path = self._path
+        self._path = None
+        try:
+            with path.open('rt') as f:
+                self._add(load_stops(json.load(f)))
+        except (OSError, ValueError):
+            pass
+        self._modified = False
+        for stops, save in self._pending:
+            self._add(stops, save)
+        self._pending.clear()
+
+    def add(self, stops: Iterable[Stop], save: bool = True) -> None:
+        '''
+        Adds stops to the index. Stops already present are ignored.
+
+        If the index was not loaded yet, they are added when it is.
+        save=False is for stops that are added every time, such as the
+        ones of a feed: they are searched, but not saved.
+        '''
+        if self._path is not None:
+            stops = list(stops)
+            if stops:
+                self._pending.append((stops, save))
+            return
+        self._add(stops, save)
+
+    def _add(self, stops: Iterable[Stop], save: bool = True) -> None:
+        prefixes = []
+        for stop in stops:
+            if stop.id in self.stops:
+                if save and stop.id in self._unsaved:
+                    # Seen elsewhere too, now it is worth saving
+                    self._unsaved.discard(stop.id)
+                    self._modified = True
+                continue
+            self.stops[stop.id] = stop
+            if save:
+                self._modified = True
+            else:
+                self._unsaved.add(stop.id)
+
+            name = normalize(stop.name)
+            prefixes.append((name, stop.id))
+            for i, c in enumerate(name):
+                if c == ' ':
+                    prefixes.append((name[i + 1:], stop.id))
+            for t in trigrams(name):
+                self._trigrams.setdefault(t, set()).add(stop.id)
+
+            if stop.lat or stop.lon:
+                la, lo = self._cell(stop.lat, stop.lon)
+                if not self._grid:
+                    self._bounds = (la, lo, la, lo)
+                min_la, min_lo, max_la, max_lo = self._bounds
+                self._bounds = (min(min_la, la), min(min_lo, lo), max(max_la, la), max(max_lo, lo))
+                self._grid.setdefault((la, lo), []).append(stop)
+
+        if prefixes:
+            self._prefixes.extend(prefixes)
+            self._prefixes.sort()
+
+    @staticmethod
+    def _cell(lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / CELL)), int(math.floor(lon / CELL))
+
+    def search(self, user_input: str, limit: int = 10) -> Stops:
+        '''
+        Returns the stops whose name matches the user input.
+
+        Stops having a word that starts with the input come first, the
+        ones with the input at the beginning of the name first.
+        If none is found, the ones sharing the most trigrams with the
+        input are returned.
+        '''
+        query = normalize(user_input)
+        if not query:
+            return []
+        self._load()
+
+        found: Dict[str, bool] = {}
+        i = bisect_left(self._prefixes, (query, ''))
+        while i < len(self._prefixes) and self._prefixes[i][0].startswith(query):
+            id = self._prefixes[i][1]
+            found[id] = found.get(id, False) or normalize(self.stops[id].name).startswith(query)
+            i += 1
+
+        if found:
+            ids = sorted(found, key=lambda id: (not found[id], len(self.stops[id].name), self.stops[id].name))
+            return [self.stops[id] for id in ids[:limit]]
+
+        scores: Dict[str, int] = {}
+        query_trigrams = trigrams(query)
+        for t in query_trigrams:
+            for id in self._trigrams.get(t, ()):
+                scores[id] = scores.get(id, 0) + 1
+        # Require at least half of the trigrams to match
+        threshold = len(query_trigrams) / 2
+        ids = sorted(
+            (id for id, score in scores.items() if score >= threshold),
+            key=lambda id: (-scores[id], len(self.stops[id].name)),
+        )
+        return [self.stops[id] for id in ids[:limit]]
+
+    def find(self, user_input: str) -> Optional[Stop]:
+        '''
+        Returns the stop that the user input names without doubt, or
+        None.
+
+        That is the only stop with that name, or with that name followed
+        by the municipality. Unlike search(), there are no fuzzy or
+        partial matches: the index only has the stops seen so far, so
+        being the only one that starts with the input proves nothing.
+        '''
+        query = normalize(user_input)
+        if not query:
+            return None
+        self._load()
+
+        exact: Set[str] = set()
+        place: Set[str] = set()
+        i = bisect_left(self._prefixes, (query, ''))
+        while i < len(self._prefixes) and self._prefixes[i][0].startswith(query):
+            id = self._prefixes[i][1]
+            name = normalize(self.stops[id].name)
+            if name == query:
+                exact.add(id)
+            elif normalize(self.stops[id].name.split(',', 1)[0]) == query:
+                place.add(id)
+            i += 1
+
+        for ids in (exact, place):
+            if ids:
+                return self.stops[ids.pop()] if len(ids) == 1 else None
+        return None
+
+    def nearby(self, lat: float, lon: float, stops: int = 10, dist: Optional[int] = None) -> Stops:
+        '''
+        Returns the stops closest to a location, same as
+        Vasttrafik.nearby()
+        '''
+        self._load()
+        if not self._grid:
+            return []
+        clat, clon = self._cell(lat, lon)
+        # A cell is at least this wide, the side along the longitude
+        # is the shorter one
+        cell_meters = CELL * 111320 * math.cos(math.radians(min(abs(lat), 89)))
+        found: List[Tuple[float, Stop]] = []
+        ring = 0
+        min_la, min_lo, max_la, max_lo = self._bounds
+        max_ring = max(clat - min_la, max_la - clat, clon - min_lo, max_lo - clon)
+        while ring <= max_ring:
+            for la in range(clat - ring, clat + ring + 1):
+                for lo in range(clon - ring, clon + ring + 1):
+                    if max(abs(la - clat), abs(lo - clon)) != ring:
+                        continue
+                    for stop in self._grid.get((la, lo), ()):
+                        found.append((distance(lat, lon, stop.lat, stop.lon), stop))
+            # Stops in the next rings are at least this far
+            reach = ring * cell_meters
+            found.sort(key=lambda x: x[0])
+            if dist is not None and reach > dist:
+                break
+            if len(found) >= stops and found[stops - 1][0] <= reach:
+                break
+            ring += 1
+        return [stop for d, stop in found if dist is None or d <= dist][:stops]
+
+    @staticmethod
+    def load(path: Path) -> 'StopIndex':
+        '''
+        Returns the index saved with save(). The file is only read when
+        the index is first used, the index is empty if the file is
+        missing or can't be read.
+        '''
+        return StopIndex(path=path)
+
+    def save(self, path: Path) -> None:
+        self._load()
+        tmp = path.with_name(path.name + '.%d' % os.getpid())
+        with tmp.open('wt') as f:
+            json.dump([i._asdict() for i in self.stops.values() if i.id not in self._unsaved], f)
+        os.replace(tmp, path)
+        self._modified = False
+
+    def import_file(self, path: Path) -> None:
+        '''
+        Imports stops from a file.
+
+        It can be a json list of stops, or a CSV file, such as the
+        stops.txt of a GTFS feed, with the columns
+        stop_id, stop_name, stop_lat, stop_lon (or id, name, lat, lon).
+        '''
+        if path.suffix == '.json':
+            with path.open('rt') as f:
+                self.add(load_stops(json.load(f)))
+            return
+
+        with path.open('rt', encoding='utf-8-sig', newline='') as f:
+            stops = []
+            for row in csv.DictReader(f):
+                def get(k: str) -> str:
+                    return row.get('stop_' + k) or row.get(k) or ''
+                stops.append(Stop(
+                    id=get('id'),
+                    name=get('name'),
+                    lat=float(get('lat') or 0),
+                    lon=float(get('lon') or 0),
+                ))
+        self.add(stops)
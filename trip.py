@@ -19,15 +19,30 @@
 
 import sys
 import datetime
+import json
 import os
-from typing import Optional
+import socket
+import threading
+from time import monotonic, perf_counter, sleep
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, TYPE_CHECKING
 from pathlib import Path
 
-from vasttrafik import Vasttrafik
+from prefetch import History, prefetch
+from recent import RecentStops
+from vasttrafik import Accessibility, BoardItem, Cache, Event, Stats, RecordTransport, ReplayTransport, Trip, Vasttrafik, upcoming
+
+# Imported only with --gtfs
+if TYPE_CHECKING:
+    from gtfs import Timetable
 
 
 CONFIGDIR = Path(os.environ.get('XDG_CONFIG_HOME', Path.home() / '.config'))
 CACHEDIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+SOCKET = Path(os.environ.get('XDG_RUNTIME_DIR', CACHEDIR)) / 'vasttrafik-cli.sock'
+# Seconds the daemon waits for a request, and the commands wait for
+# the daemon to accept it and to run it
+REQUEST_TIMEOUT = 2
+REPLY_TIMEOUT = 60
 
 
 def init() -> None:
@@ -68,50 +83,151 @@ def get_key() -> str:
     return config['key']
 
 
-key = get_key()
-vast = Vasttrafik(key, CACHEDIR / 'vasttrafik-cli-token')
+# Created on first use by get_vast()
+vast: Optional[Vasttrafik] = None
 
+# Plans the trips instead of the API, with --gtfs
+timetable: Optional['Timetable'] = None
 
-def save_completion(name: str) -> None:
-    """
-    Saves the name of the stop in the completion file
-    """
-    # Trim up to the part completion can manage
-    for char in ' ,':
-        if char in name:
-            name = name.split(char, 1)[0]
-    # Only lower
-    name = name.lower()
 
-    # Read file or presume empty
-    path = CACHEDIR / 'vasttrafik-cli-stops'
-    if path.exists():
-        with path.open('rt') as f:
-            lines = [i.strip() for i in f]
-    else:
-        lines = []
+def get_vast() -> Vasttrafik:
+    '''
+    Returns the client, creating it the first time.
+    '''
+    global vast
+    if vast is None:
+        from stopindex import StopIndex
+        vast = Vasttrafik(
+            get_key(),
+            CACHEDIR / 'vasttrafik-cli-token',
+            cache=Cache(CACHEDIR / 'vasttrafik-cli-cache.sqlite'),
+            stopindex=StopIndex.load(CACHEDIR / 'vasttrafik-cli-stopindex.json'),
+        )
+    return vast
 
-    # Do nothing if completion is there already
-    if name in lines:
-        return
 
-    # Append new stop to completion
-    lines.append(name)
+# The stops used recently, for the completion
+recent = RecentStops(CACHEDIR / 'vasttrafik-cli-recent', old_path=CACHEDIR / 'vasttrafik-cli-stops')
+
+# The boards and trips requested, to prefetch them
+history = History(CACHEDIR / 'vasttrafik-cli-history')
+
+# Parameters of the boards shown by stops
+TIME_SPAN = 120
+DEPARTURES = 4
+
+# Expired boards from the cache are shown while updating them, if they
+# are not older than this, in seconds
+MAX_STALE = 600
+
+# Set by --refresh, ignores the cached stops
+refresh = False
+
+# Set by --watch, keeps the board on screen and updates it every
+# interval seconds
+watch = False
+interval = 30.0
+# Shortest interval accepted, not to flood the API
+MIN_INTERVAL = 5
+
+
+def use_color() -> bool:
+    '''
+    Colours are only used on terminals that support them
+    '''
+    term = os.environ.get('TERM', '')
+    return sys.stdout.isatty() and (term.startswith('xterm') or term == 'vt100')
+
+
+color = use_color()
+
+# Set by --format: text, ndjson or csv
+output_format = 'text'
+
+
+def pop_option(name: str, has_value: bool = False) -> Optional[str]:
+    '''
+    Removes an option from the command line.
+
+    Returns None if it is absent, otherwise its value, or an empty
+    string for options without value.
+
+    A value can also be given as name=value, also to options that
+    don't require it.
+    '''
+    for i, arg in enumerate(sys.argv):
+        if arg.startswith(name + '='):
+            del sys.argv[i]
+            return arg[len(name) + 1:]
+    if name not in sys.argv:
+        return None
+    i = sys.argv.index(name)
+    if not has_value:
+        del sys.argv[i]
+        return ''
+    if i + 1 == len(sys.argv):
+        sys.exit(f'{name} requires a value')
+    value = sys.argv[i + 1]
+    del sys.argv[i:i + 2]
+    return value
+
+
+class Records:
+    '''
+    Writes records for other programs, as json or CSV lines, flushing
+    after each one so they can be read while they arrive.
+    '''
 
-    # Remove old completions, if necessary
-    if len(lines) > 100:
-        lines.pop(0)
+    def __init__(self, fields: List[str]) -> None:
+        self.fields = fields
+        self._csv = None
+        if output_format == 'csv':
+            import csv
+            self._csv = csv.DictWriter(sys.stdout, fields, lineterminator='\n')
+            self._csv.writeheader()
 
-    # Write the file again
-    with path.open('wt') as f:
-        f.write('\n'.join(lines))
+    def write(self, record: Dict[str, Any]) -> None:
+        if self._csv is not None:
+            self._csv.writerow(record)
+        else:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+
+def write(lines: List[str]) -> None:
+    '''
+    Writes the lines on stdout all at once, to avoid flickering.
+    '''
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
+
+
+def screen_rows(lines: List[str], columns: int) -> int:
+    '''
+    Returns how many rows of the terminal the lines take, counting the
+    long ones as many rows, as the terminal wraps them.
+    '''
+    import re
+    import unicodedata
+    rows = 0
+    for line in lines:
+        # Colors take no space, tabs go to the next multiple of 8
+        line = re.sub(r'\033\[[0-9;]*m', '', line).expandtabs()
+        width = sum(
+            0 if unicodedata.combining(c) else 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+            for c in line
+        )
+        rows += max(1, -(-width // columns))
+    return rows
 
 
 def get_stop(prompt, preset=None):
     if preset:
-        r = vast.location(preset)
-        save_completion(r[0].name)
-        return r[0]
+        stop = None if refresh else recent.find(preset)
+        if stop is None:
+            stop = get_vast().stop(preset, refresh, offline=not refresh)
+        recent.add(stop, preset)
+        return stop
 
     while True:
         try:
@@ -121,7 +237,8 @@ def get_stop(prompt, preset=None):
         if not line:
             return None
 
-        stops = vast.location(line)
+        query = line
+        stops = get_vast().location(line, refresh)
 
         for i in range(len(stops)):
             print("%d: %s" % (i, stops[i].name))
@@ -134,15 +251,18 @@ def get_stop(prompt, preset=None):
             except (KeyboardInterrupt, EOFError):
                 sys.exit(0)
             try:
-                save_completion(stops[int(line)].name)
+                recent.add(stops[int(line)], query)
                 return stops[int(line)]
             except:
                 break
 
 
-def get_time(default):
+def get_time(default) -> Optional[datetime.datetime]:
+    '''
+    Returns the time chosen by the user, or None for now.
+    '''
     if default:
-        return datetime.datetime.now()
+        return None
 
     try:
         line = input('Insert time? [N/y]')
@@ -151,7 +271,7 @@ def get_time(default):
     except EOFError:
         line = ''
     if line != 'y':
-        return datetime.datetime.now()
+        return None
 
     try:
         hour = input('Hour: ')
@@ -181,35 +301,513 @@ def tripmain():
         return
 
     time = get_time(len(sys.argv) == 3)
+    if time is None:
+        history.add('trip', (origstop.id, deststop.id))
+
+    trips: Iterable[Trip]
+    if timetable is not None:
+        trips = timetable.trip(originId=origstop.id, destId=deststop.id, datetime_obj=time)
+    elif output_format != 'text':
+        trips = get_vast().iter_trip(originId=origstop.id, destId=deststop.id, datetime_obj=time, refresh=refresh)
+    else:
+        trips = get_vast().trip(originId=origstop.id, destId=deststop.id, datetime_obj=time, refresh=refresh)
+
+    if output_format != 'text':
+        trip_records(trips)
+        return
+
+    start = perf_counter()
+    out = ['\t%s → %s\t Trips since: %s' % (origstop.name, deststop.name, str(time or datetime.datetime.now()))]
+    for i in trips:
+        out.append(i.toTxt(color))
+        out.append("=========================")
+    write(out)
+    get_vast().emit(Event('render', 'trip', perf_counter() - start))
+
+
+def trip_records(trips: Iterable[Trip]) -> None:
+    '''
+    Writes a record for every leg of the trips.
+    '''
+    out = Records([
+        'trip', 'name', 'sname', 'type', 'direction',
+        'origin', 'origin_id', 'origin_track', 'departure',
+        'destination', 'destination_id', 'destination_track', 'arrival',
+    ])
+    for n, trip in enumerate(trips):
+        for leg in trip.legs:
+            out.write({
+                'trip': n,
+                'name': leg.name,
+                'sname': leg.sname,
+                'type': leg.type.value,
+                'direction': leg.direction,
+                'origin': leg.Origin.name,
+                'origin_id': leg.Origin.id,
+                'origin_track': leg.Origin.track,
+                'departure': leg.Origin.datetime_obj.isoformat(),
+                'destination': leg.Destination.name,
+                'destination_id': leg.Destination.id,
+                'destination_track': leg.Destination.track,
+                'arrival': leg.Destination.datetime_obj.isoformat(),
+            })
+
+
+def board_records(stops, servertime, boards, first=None) -> None:
+    '''
+    Writes a record for every departure, in the same order as
+    board_lines().
+    '''
+    out = Records([
+        'stop', 'stop_id', 'track', 'name', 'sname', 'type', 'direction',
+        'departure', 'minutes', 'accessible', 'night',
+    ])
+    departures: List[Tuple[datetime.datetime, Any, BoardItem]] = []
+    for stop in stops:
+        board = boards[stop.id]
+        if isinstance(board, Exception):
+            print(f'{stop.name}: {board}', file=sys.stderr)
+            continue
+        departures.extend((d, stop, i) for i in board for d in sorted(i.datetime_obj))
+    if first is not None:
+        departures.sort(key=lambda x: x[0])
+        departures = departures[:first]
+    for d, stop, i in departures:
+        out.write({
+            'stop': stop.name,
+            'stop_id': stop.id,
+            'track': i.track,
+            'name': i.name,
+            'sname': i.sname,
+            'type': i.vehicle_type.value,
+            'direction': i.direction,
+            'departure': d.isoformat(),
+            'minutes': (d - servertime).seconds // 60,
+            'accessible': i.accessibility == Accessibility.WHEEL_CHAIR,
+            'night': bool(i.night),
+        })
+
+
+def get_boards(stops, refresh: bool) -> Tuple[datetime.datetime, Dict[str, Union[List[BoardItem], Exception]], float]:
+    '''
+    Requests the boards of the stops concurrently.
+
+    Returns the server time, the most recent among the replies, for
+    every stop id its board, or the exception if it failed, and the age
+    of the oldest board, if some are expired boards from the cache,
+    returned because the API failed, or 0.
+    '''
+    client = get_vast()
+    boards = client.board_many([i.id for i in stops], time_span=TIME_SPAN, departures=DEPARTURES, refresh=refresh)
+    found = [b for b in boards.values() if not isinstance(b, Exception)]
+    servertime = max(b.servertime for b in found) if found else datetime.datetime.now()
+    ttl = client.cache.ttl.get('departureBoard', 0) if client.cache is not None else 0
+    age = max([b.age for b in found if b.age >= ttl] + [0])
+    # The older boards can have departures before the time shown
+    return servertime, {id: b if isinstance(b, Exception) else upcoming(servertime, b.items) for id, b in boards.items()}, age
+
 
-    print('\t%s → %s\t Trips since: %s' % (origstop.name, deststop.name, str(time)))
-    for i in vast.trip(originId=origstop.id, destId=deststop.id, datetime_obj=time):
-        print(i.toTerm())
-        print("=========================")
+def get_stale_boards(stops) -> Optional[Tuple[datetime.datetime, Dict[str, Union[List[BoardItem], Exception]], float]]:
+    '''
+    Returns the expired boards of the stops from the cache, if there
+    are all of them and they are not too old.
+
+    Returns the server time, the boards and the age of the oldest one.
+    '''
+    client = get_vast()
+    if client.cache is None:
+        return None
+    cached = [client.cached_board(i.id, time_span=TIME_SPAN, departures=DEPARTURES, max_age=MAX_STALE) for i in stops]
+    found = [i for i in cached if i is not None]
+    if len(found) != len(stops):
+        return None
+    age = max(i[1] for i in found)
+    if age < client.cache.ttl.get('departureBoard', 0):
+        # Not expired, get_boards() will be just as fast
+        return None
+    servertime = max(i[0].servertime for i in found)
+    return servertime, {stop.id: i[0].items for stop, i in zip(stops, found)}, age
+
+
+def board_lines(stops, servertime, boards, timeformat=None, first=None) -> List[str]:
+    '''
+    Returns the lines showing the boards of the stops, grouped by stop
+    and track.
+
+    If first is set, the first departures from all the stops are shown
+    instead, ordered by time.
+    '''
+    time = servertime.strftime(timeformat) if timeformat else servertime
+    out = []
+    if first is not None:
+        out.append("\t\tNext departures, Time: %s\n" % time)
+        departures: List[Tuple[datetime.datetime, str, BoardItem]] = []
+        for stop in stops:
+            board = boards[stop.id]
+            if isinstance(board, Exception):
+                out.append('   %s: %s' % (stop.name, board))
+                continue
+            departures.extend((d, stop.name, i) for i in board for d in i.datetime_obj)
+        departures.sort(key=lambda x: x[0])
+        for d, name, i in departures[:first]:
+            out.append('%s %0*d -> %s # %s, %s' % (i.getName(color), 2, (d - servertime).seconds // 60, i.direction, name, i.track))
+        return out
+
+    for stop in stops:
+        if out:
+            out.append('')
+        out.append("\t\t%s, Time: %s\n" % (stop.name, time))
+        board = boards[stop.id]
+        if isinstance(board, Exception):
+            out.append('   %s' % board)
+            continue
+        prev_track = None
+        for i in board:
+            if prev_track != i.track:
+                out.append("   == Track %s ==" % i.track)
+            prev_track = i.track
+            out.append(i.toTerm(servertime, color))
+    return out
+
+
+def watchmain(stops, first=None) -> None:
+    '''
+    Keeps the boards on screen, requesting it again every interval
+    seconds.
+
+    Between the requests, the countdowns are computed from the server
+    time of the last reply plus the time elapsed since. Only the lines
+    that changed are written again.
+    '''
+    tty = sys.stdout.isatty()
+    screen: List[str] = []
+    error = ''
+    # When the last request was attempted, to schedule the next one
+    attempted = -interval
+    # The server time and when it was obtained, they only move together
+    fetched = monotonic()
+    servertime = datetime.datetime.now()
+    boards: Dict[str, Union[List[BoardItem], Exception]] = {}
+
+    if tty:
+        # Clear and hide the cursor
+        sys.stdout.write('\033[H\033[2J\033[?25l')
+    try:
+        while True:
+            now = monotonic()
+            if now - attempted >= interval:
+                attempted = now
+                try:
+                    # The first board can come from the cache
+                    new_servertime, new_boards, age = get_boards(stops, refresh or bool(boards))
+                except Exception as e:
+                    # Keep showing the old boards
+                    error = f'Update failed: {e}'
+                    for stop in stops:
+                        boards.setdefault(stop.id, e)
+                else:
+                    # Keep the old board of the stops that failed
+                    for id, board in new_boards.items():
+                        if not isinstance(board, Exception) or id not in boards:
+                            boards[id] = board
+                    servertime = new_servertime
+                    fetched = now
+                    failed = [i.name for i in stops if isinstance(new_boards[i.id], Exception)]
+                    error = f'Update failed: {", ".join(failed)}' if failed else ''
+                    if age and not error:
+                        error = 'Update failed, the boards are from %d minutes ago' % (age // 60)
+
+            estimated = servertime + datetime.timedelta(seconds=now - fetched)
+            current = {id: b if isinstance(b, Exception) else upcoming(estimated, b) for id, b in boards.items()}
+            lines = board_lines(stops, estimated, current, '%Y-%m-%d %H:%M', first)
+            # One item per row on the screen
+            lines = '\n'.join(lines).split('\n')
+            lines.append(error)
+
+            if not tty:
+                if lines != screen:
+                    write(lines)
+            else:
+                out = []
+                for row, line in enumerate(lines):
+                    if row >= len(screen) or screen[row] != line:
+                        out.append('\033[%d;1H%s\033[K' % (row + 1, line))
+                if len(lines) < len(screen):
+                    # Clear what is left below
+                    out.append('\033[%d;1H\033[J' % (len(lines) + 1))
+                if out:
+                    sys.stdout.write(''.join(out))
+                    sys.stdout.flush()
+            screen = lines
+
+            # Wake up when the minute changes or it's time to request again
+            now = monotonic()
+            elapsed = now - fetched
+            sleep(max(0.05, min(interval - (now - attempted), 60 - (servertime.second + elapsed) % 60)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tty:
+            # Show the cursor again, below the board
+            sys.stdout.write('\033[%d;1H\033[?25h' % (len(screen) + 1))
+            sys.stdout.flush()
 
 
 def stopsmain():
-    if len(sys.argv) > 2:
-        sys.exit('Invalid number of parameters')
-    preset = sys.argv[1] if len(sys.argv) == 2 else ''
-    stop = get_stop('> ', preset)
-    trams = vast.board(stop.id, time_span=120, departures=4)
+    option = pop_option('--next', True)
+    try:
+        first = None if option is None else int(option)
+    except ValueError:
+        sys.exit('--next requires a number')
+    if len(sys.argv) == 1:
+        stops = [get_stop('> ')]
+    else:
+        stops = [get_stop('> ', i) for i in sys.argv[1:]]
+    # The same stop only once
+    stops = list({i.id: i for i in stops if i is not None}.values())
+    if not stops:
+        return
+    for i in stops:
+        history.add('board', (i.id,))
+    if watch:
+        watchmain(stops, first)
+        return
+
+    # On a terminal, show the expired boards while requesting them
+    stale = None
+    if output_format == 'text' and not refresh and sys.stdout.isatty():
+        stale = get_stale_boards(stops)
+    rows = 0
+    if stale is not None:
+        servertime, boards, age = stale
+        lines = '\n'.join(board_lines(stops, servertime, boards, first=first)).split('\n')
+        lines.insert(0, 'Updating, this is from %d minutes ago…' % (age // 60))
+        # They can only be replaced while they are all on the screen
+        import shutil
+        size = shutil.get_terminal_size()
+        height = screen_rows(lines, size.columns)
+        if height < size.lines:
+            write(lines)
+            rows = height
+
+    servertime, boards, age = get_boards(stops, refresh)
+    errors = [b for b in boards.values() if isinstance(b, Exception)]
+    if len(errors) == len(boards):
+        raise errors[0]
+    stale_note = 'Update failed, this is from %d minutes ago' % (age // 60) if age else None
+    if output_format != 'text':
+        if stale_note:
+            print(stale_note, file=sys.stderr)
+        board_records(stops, servertime, boards, first)
+        return
+    start = perf_counter()
+    if rows:
+        # Back to the start of the old boards, and clear them
+        sys.stdout.write('\033[%dF\033[J' % rows)
+    lines = board_lines(stops, servertime, boards, first=first)
+    if stale_note:
+        lines.insert(0, stale_note)
+    write(lines)
+    get_vast().emit(Event('render', 'stops', perf_counter() - start))
+
+
+def run(cmdname: str) -> None:
+    try:
+        if cmdname.startswith('trip'):
+            tripmain()
+        elif cmdname.startswith('stops'):
+            stopsmain()
+    finally:
+        if vast is not None and vast.stopindex is not None and vast.stopindex.modified:
+            vast.stopindex.save(CACHEDIR / 'vasttrafik-cli-stopindex.json')
 
-    print("\t\t%s, Time: %s\n" % (stop.name, vast.datetime_obj))
-    prev_track = None
-    for i in trams:
-        if prev_track != i.track:
-            print("   == Track %s ==" % i.track)
-        prev_track = i.track
-        print(i.toTerm(vast.datetime_obj))
+
+def forward(cmdname: str) -> bool:
+    '''
+    Runs the command in the daemon, if it is running, and exits.
+
+    Returns False if there is no daemon, or it doesn't answer in time,
+    and the command must run in this process.
+    '''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(REQUEST_TIMEOUT)
+            s.connect(str(SOCKET))
+            request = {'cmd': cmdname, 'argv': sys.argv[1:], 'color': color}
+            s.sendall(json.dumps(request).encode('utf8') + b'\n')
+            s.shutdown(socket.SHUT_WR)
+            s.settimeout(REPLY_TIMEOUT)
+            data = b''.join(iter(lambda: s.recv(65536), b''))
+        reply = json.loads(data)
+    except (OSError, ValueError):
+        return False
+    sys.stdout.write(reply['stdout'])
+    sys.stdout.flush()
+    sys.stderr.write(reply['stderr'])
+    sys.exit(reply['status'])
+
+
+def prefetcher() -> None:
+    '''
+    Every minute, puts in the cache the boards and trips that are
+    usually requested in the next minutes.
+    '''
+    while True:
+        try:
+            prefetch(get_vast(), history, datetime.datetime.now(), TIME_SPAN, DEPARTURES)
+        except Exception:
+            pass
+        sleep(60)
+
+
+def daemonmain() -> None:
+    '''
+    Keeps running, with the connections, token and caches ready, and
+    runs the commands forwarded by trip and stops.
+    '''
+    import contextlib
+    import io
+    import signal
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        # A client that sends nothing must not block the others
+        timeout = REQUEST_TIMEOUT
+
+        def handle(self):
+            global color
+            try:
+                request = json.loads(self.rfile.readline())
+            except (OSError, ValueError):
+                return
+            sys.argv = [request['cmd']] + request['argv']
+            color = request['color']
+
+            out = io.StringIO()
+            err = io.StringIO()
+            status = 0
+            try:
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                    run(request['cmd'])
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    status = e.code
+                elif e.code is not None:
+                    err.write(f'{e.code}\n')
+                    status = 1
+            except Exception as e:
+                err.write(f'{e}\n')
+                status = 1
+            reply = {'stdout': out.getvalue(), 'stderr': err.getvalue(), 'status': status}
+            self.wfile.write(json.dumps(reply).encode('utf8'))
+
+    if SOCKET.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(str(SOCKET))
+                sys.exit('The daemon is already running')
+            except OSError:
+                # Left over by a daemon that died
+                SOCKET.unlink()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threading.Thread(target=prefetcher, daemon=True).start()
+
+    # One command at a time, since they use stdout and sys.argv
+    with socketserver.UnixStreamServer(str(SOCKET), Handler) as server:
+        SOCKET.chmod(0o600)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            SOCKET.unlink()
 
 
 if __name__ == '__main__':
 
     init()
 
+    if pop_option('--daemon') is not None:
+        daemonmain()
+        sys.exit(0)
+
+    if pop_option('--prefetch') is not None:
+        sys.exit(prefetch(get_vast(), history, datetime.datetime.now(), TIME_SPAN, DEPARTURES) != 0)
+
+    refresh = pop_option('--refresh') is not None
+    output_format = pop_option('--format', True) or output_format
+    if output_format not in {'text', 'ndjson', 'csv'}:
+        sys.exit('--format must be text, ndjson or csv')
+    watch = pop_option('--watch') is not None
+    option = pop_option('--interval', True)
+    if option is not None:
+        try:
+            interval = float(option)
+        except ValueError:
+            interval = 0
+        # Also false for nan
+        if not interval >= MIN_INTERVAL:
+            sys.exit('--interval requires a number of seconds, at least %d' % MIN_INTERVAL)
+    if watch and output_format != 'text':
+        sys.exit('--watch only works with --format text')
+
+    record = pop_option('--record', True)
+    replay = pop_option('--replay', True)
+    if record:
+        get_vast().transport = RecordTransport(Path(record), get_vast().transport)
+        # Every request must reach the transport, none is answered by
+        # the caches or the recent stops
+        refresh = True
+    elif replay:
+        get_vast().transport = ReplayTransport(Path(replay))
+        get_vast().cache = None
+
+    archive = pop_option('--archive') is not None
+    if archive:
+        from archive import Archive
+        get_vast().hooks.append(Archive())
+
+    feed = pop_option('--gtfs', True)
+    if feed:
+        from gtfs import Timetable
+        timetable = Timetable.open(Path(feed), CACHEDIR / 'vasttrafik-cli-timetable')
+        # To find the stops without the API
+        stopindex = get_vast().stopindex
+        if stopindex is not None:
+            stopindex.add(timetable.stops(), save=False)
+
     cmdname = Path(sys.argv[0]).name
+
+    # Only the commands that don't ask anything can go to the daemon
     if cmdname.startswith('trip'):
-        tripmain()
-    elif cmdname.startswith('stops'):
-        stopsmain()
+        interactive = len(sys.argv) != 3
+    else:
+        # stopsmain() reads --next again, in whatever form it was given
+        argv = sys.argv[:]
+        pop_option('--next', True)
+        interactive = len(sys.argv) == 1
+        sys.argv = argv
+    stats = pop_option('--stats')
+    # The daemon returns the output all at once, ndjson and csv are streamed
+    streamed = output_format != 'text'
+    if not (refresh or watch or record or replay or archive or feed or interactive or streamed or stats is not None):
+        forward(cmdname)
+
+    if stats:
+        # Profile everything, into the file
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(run, cmdname)
+        finally:
+            profile.dump_stats(stats)
+    elif stats is not None:
+        collector = Stats()
+        get_vast().hooks.append(collector)
+        try:
+            run(cmdname)
+        finally:
+            print(collector.summary(), file=sys.stderr)
+    else:
+        run(cmdname)
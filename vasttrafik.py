@@ -16,20 +16,43 @@
 #
 # author Salvo "LtWorf" Tomaselli <tiposchi@tiscali.it>
 
+import copy
 from dataclasses import dataclass, field
-import urllib.request
+import threading
 import urllib.parse
 import datetime
 from enum import Enum
+import fcntl
+from functools import lru_cache
+import importlib
 import json
+import os
 import re
-from time import time
-from typing import Dict, List, Optional, NamedTuple, Union
+import sys
+from time import monotonic, perf_counter, sleep, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, NamedTuple, Protocol, Set, Tuple, Union, TYPE_CHECKING
 from pathlib import Path
 
-from wcwidth import wcswidth as ulen  # type: ignore
-from typedload import load, dump
-from xtermcolor import colorize  # type: ignore
+# The modules that are slow to import, or only needed in some cases,
+# are imported when they are used, so that the commands start faster.
+
+if TYPE_CHECKING:
+    import asyncio
+    from concurrent.futures import Future
+    import http.client
+    import sqlite3
+    import ssl
+    from stopindex import StopIndex
+
+
+def load(value: Any, type_: Any) -> Any:
+    from typedload import load
+    return load(value, type_)
+
+
+def dump(value: Any) -> Any:
+    from typedload import dump
+    return dump(value)
 
 
 class Stop(NamedTuple):
@@ -59,19 +82,148 @@ class Token:
         return self.expires_in < time()
 
 
+@lru_cache(maxsize=None)
+def _json_backend() -> Callable[[bytes], Any]:
+    '''
+    Returns the fastest json decoder available
+    '''
+    try:
+        return importlib.import_module('orjson').loads
+    except ImportError:
+        return json.loads
+
+
+def json_loads(data: bytes) -> Any:
+    return _json_backend()(data)
+
+
+class TokenManager:
+    '''
+    Keeps the token, sharing it between threads and, using a file,
+    between processes.
+
+    The file is locked while renewing, so that only one process
+    performs the request, and it is replaced atomically so it is never
+    read half written.
+
+    When less than margin seconds are left before the token expires, a
+    new one is requested in a background thread, while the old one
+    keeps being used.
+    '''
+
+    def __init__(self, path: Path, renew: Callable[[], Token], margin: int = 300) -> None:
+        self.path = path
+        self.margin = margin
+        self._renew = renew
+        self._token: Optional[Token] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        # Held while renewing, so that threads share a single renewal
+        self._renew_lock = threading.Lock()
+        self._background: Optional[threading.Thread] = None
+
+    def _read(self) -> Optional[Token]:
+        try:
+            with self.path.open('rt') as f:
+                return load(json.load(f), Token)
+        except Exception:
+            return None
+
+    def _write(self, token: Token) -> None:
+        tmp = self.path.with_name('%s.%d.%d' % (self.path.name, os.getpid(), threading.get_ident()))
+        with tmp.open('wt') as f:
+            json.dump(dump(token), f)
+        os.replace(tmp, self.path)
+
+    def _fresh(self, token: Optional[Token]) -> bool:
+        return token is not None and token.expires_in - self.margin > time()
+
+    def _refresh(self) -> Token:
+        '''
+        Renews the token, unless another process did it already.
+        Must be called with _renew_lock held.
+        '''
+        with self.path.with_name(self.path.name + '.lock').open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            token = self._read()
+            if not self._fresh(token):
+                token = self._renew()
+                self._write(token)
+        assert token is not None
+        with self._lock:
+            self._token = token
+        return token
+
+    def _refresh_background(self) -> None:
+        with self._renew_lock:
+            if self._fresh(self._token):
+                return
+            try:
+                self._refresh()
+            except Exception:
+                # The current token is still valid, it will be tried again
+                pass
+
+    def current(self) -> Optional[Token]:
+        '''
+        Returns the token if it is still valid, without blocking on the
+        network. Starts renewing it in background if it is about to
+        expire.
+        '''
+        token = self._token
+        if self._fresh(token):
+            return token
+
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                self._token = self._read()
+            token = self._token
+            if token is None or token.expired():
+                return None
+            if self._fresh(token):
+                return token
+            if self._background is None or not self._background.is_alive():
+                self._background = threading.Thread(target=self._refresh_background, daemon=True)
+                self._background.start()
+        return token
+
+    def get(self) -> Token:
+        '''
+        Returns a valid token, renewing it if needed.
+        '''
+        token = self.current()
+        if token is not None:
+            return token
+        with self._renew_lock:
+            # Another thread might have renewed it while waiting
+            token = self._token
+            if token is not None and not token.expired():
+                return token
+            return self._refresh()
+
+
+_DATE_RE = re.compile(r'^([0-9]{1,4})-([0-9]{1,2})-([0-9]{1,2})$')
+_TIME_RE = re.compile(r'^([0-9]{1,2}):([0-9]{1,2})$')
+
+
+@lru_cache(maxsize=4096)
 def to_datetime(date: str, time: str) -> datetime.datetime:
     '''Converts two string date and time into a datetime object
 
     date format YYYY-MM-DD
     time format HH:MM
+
+    The results are cached, since the same times appear again and
+    again on boards and trips.
     '''
-    r = re.match(r'^([0-9]{1,4})-([0-9]{1,2})-([0-9]{1,2})$', date)
+    r = _DATE_RE.match(date)
     if r is None:
         raise Exception(f'Incorrect format: {date}')
     year = int(r.group(1))
     month = int(r.group(2))
     day = int(r.group(3))
-    r = re.match(r'^([0-9]{1,2}):([0-9]{1,2})$', time)
+    r = _TIME_RE.match(time)
     if r is None:
         raise Exception(f'Incorrect format: {time}')
     hour = int(r.group(1))
@@ -79,100 +231,906 @@ def to_datetime(date: str, time: str) -> datetime.datetime:
     return datetime.datetime(year, month, day, hour, minute)
 
 
+@lru_cache(maxsize=None)
+def _colormap():
+    from xtermcolor.ColorMap import VT100ColorMap, XTermColorMap  # type: ignore
+    if os.environ.get('TERM') == 'vt100':
+        return VT100ColorMap()
+    return XTermColorMap()
+
+
+@lru_cache(maxsize=None)
+def _color_codes(fgcolor: str, bgcolor: str) -> Tuple[str, str]:
+    '''
+    Returns the escape sequences that start and end a string coloured
+    with the colours in #rrggbb format.
+    '''
+    start, end = _colormap().colorize('\0', int(fgcolor[1:], 16), bg=int(bgcolor[1:], 16)).split('\0')
+    return start, end
+
+
+@lru_cache(maxsize=1024)
+def name_cell(name: str, width: int, fgcolor: Optional[str] = None, bgcolor: Optional[str] = None) -> str:
+    '''
+    Aligns name to the right of a cell that is width columns wide
+    on the terminal.
+
+    If the colours are passed, it is coloured with them.
+
+    The same lines show up over and over, so the results are cached.
+    '''
+    from wcwidth import wcswidth as ulen  # type: ignore
+    name = ' ' * (width - max(ulen(name), 0)) + name
+    if fgcolor is None or bgcolor is None:
+        return name
+    start, end = _color_codes(fgcolor, bgcolor)
+    return start + name + end
+
+
+class Response(NamedTuple):
+    status: int
+    reason: str
+    body: bytes
+
+
+class Event(NamedTuple):
+    '''
+    Passed to the hooks of Vasttrafik, to measure what it does.
+
+    kind is one of:
+        request: a request to the API, seconds until the whole reply
+            was read and size its length in bytes, once decompressed
+        connect: a new connection, seconds for the TCP and TLS
+            handshakes. service is the host
+        cache: the cache was read, hit tells if the reply was there
+        stopindex: the stop index was searched, hit tells if stops were
+            found there
+        coalesced: a board was requested, hit tells if the reply of an
+            identical request in progress was used
+        decode: the json of a reply was decoded in seconds
+        parse: the objects were built from the json in seconds
+        token: the token was renewed in seconds
+        render: the output was created in seconds
+        retry: a request is tried again after waiting seconds
+        throttle: a request waits seconds for the rate limiter
+        stale: a request failed, hit tells if an expired cached reply
+            was used
+        board: a board was obtained from the API. service is the id of
+            the stop and data the Board, with the items not grouped
+    '''
+    kind: str
+    service: str
+    seconds: float = 0.0
+    size: int = 0
+    hit: bool = False
+    data: Any = None
+
+
+Hook = Callable[[Event], None]
+
+
+# Events that tell if something was found, rather than how long it took
+HIT_KINDS = frozenset(('cache', 'stopindex', 'coalesced', 'stale'))
+
+# Events that carry data rather than measurements
+DATA_KINDS = frozenset(('board',))
+
+# Upper limits of the buckets of the latency histogram, in milliseconds
+LATENCY_BUCKETS = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+@dataclass
+class Total:
+    count: int = 0
+    seconds: float = 0.0
+    size: int = 0
+    hits: int = 0
+    # Amount of events in every bucket, and then the slower ones
+    histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+
+class Stats:
+    '''
+    Collects the events, to be added to the hooks of Vasttrafik.
+
+    The totals are kept for every kind and service.
+    '''
+
+    def __init__(self) -> None:
+        self.totals: Dict[Tuple[str, str], Total] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Event) -> None:
+        if event.kind in DATA_KINDS:
+            return
+        ms = event.seconds * 1000
+        with self._lock:
+            total = self.totals.get((event.kind, event.service))
+            if total is None:
+                total = self.totals[event.kind, event.service] = Total()
+            total.count += 1
+            total.seconds += event.seconds
+            total.size += event.size
+            total.hits += event.hit
+            for i, limit in enumerate(LATENCY_BUCKETS):
+                if ms <= limit:
+                    total.histogram[i] += 1
+                    break
+            else:
+                total.histogram[-1] += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            totals = sorted(self.totals.items())
+        timed = [
+            '%-10s %-28s %6d %10d %10.3f %8.3f' % (kind, service, t.count, t.size, t.seconds * 1000, t.seconds * 1000 / t.count)
+            for (kind, service), t in totals if kind not in HIT_KINDS
+        ]
+        hits = [
+            '%-10s %-28s %6d %10d %9d%%' % (kind, service, t.count, t.hits, 100 * t.hits // t.count)
+            for (kind, service), t in totals if kind in HIT_KINDS
+        ]
+        histogram = [
+            '%-10s %-28s %s' % (kind, service, ' '.join('%6d' % i for i in t.histogram))
+            for (kind, service), t in totals if kind == 'request'
+        ]
+
+        r = []
+        if timed:
+            r.append('%-10s %-28s %6s %10s %10s %8s' % ('', '', 'count', 'bytes', 'total ms', 'mean ms'))
+            r += timed
+        if hits:
+            r.append('%-10s %-28s %6s %10s %10s' % ('', '', 'count', 'hits', 'hit rate'))
+            r += hits
+        if histogram:
+            r.append('%-10s %-28s %s' % ('', 'latency ms', ' '.join('%6s' % ('<=%d' % i) for i in LATENCY_BUCKETS) + '  >%d' % LATENCY_BUCKETS[-1]))
+            r += histogram
+        return '\n'.join(r)
+
+
+class HTTPPool:
+    '''
+    Keeps a pool of persistent HTTPS connections, so that the TCP and TLS
+    handshakes are done only once per connection instead of once per
+    request.
+
+    size is the maximum amount of idle connections kept for each host.
+    timeout is the socket timeout in seconds.
+
+    It is safe to use it from multiple threads.
+    '''
+
+    def __init__(self, size: int = 4, timeout: float = 10.0, context: Optional['ssl.SSLContext'] = None, hooks: Optional[List[Hook]] = None) -> None:
+        self.size = size
+        self.timeout = timeout
+        self._context = context
+        # Called with the connect events
+        self.hooks = hooks if hooks is not None else []
+        self._idle: Dict[str, List['http.client.HTTPSConnection']] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, host: str) -> Optional['http.client.HTTPSConnection']:
+        with self._lock:
+            conns = self._idle.get(host)
+            if conns:
+                return conns.pop()
+        return None
+
+    def _release(self, host: str, conn: 'http.client.HTTPSConnection') -> None:
+        with self._lock:
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def request(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> Response:
+        '''
+        Performs a request and returns the complete, decompressed, body.
+        '''
+        import gzip
+        import http.client
+
+        u = urllib.parse.urlsplit(url)
+        path = u.path + ('?' + u.query if u.query else '')
+        headers = dict(headers)
+        headers['Accept-Encoding'] = 'gzip'
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        while True:
+            conn = self._acquire(u.netloc)
+            reused = conn is not None
+            if conn is None:
+                conn = http.client.HTTPSConnection(u.netloc, timeout=self.timeout, context=self._context)
+                if self.hooks:
+                    start = perf_counter()
+                    try:
+                        conn.connect()
+                    except Exception:
+                        conn.close()
+                        raise
+                    event = Event('connect', u.netloc, perf_counter() - start)
+                    for hook in self.hooks:
+                        hook(event)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                conn.close()
+                # The server closed an idle connection, try a fresh one
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(u.netloc, conn)
+
+        if resp.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return Response(resp.status, resp.reason, data)
+
+
+class Transport(Protocol):
+    '''
+    Performs the HTTP requests for Vasttrafik.
+
+    HTTPPool performs them on the network, RecordTransport saves them
+    in a cassette file, ReplayTransport answers from a cassette.
+    '''
+
+    def request(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> Response:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+def _cassette_open(path: Path, mode: str):
+    import gzip
+    if path.suffix == '.gz':
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return path.open(mode + 't', encoding='utf8')
+
+
+def _cassette_key(method: str, url: str, exact: bool = True) -> Tuple[str, str]:
+    '''
+    The key to find a request in a cassette.
+
+    Only the name of the service and the query are used, so that the
+    requests can be recorded from a different server or API version.
+
+    When not exact, the date and time of the query are ignored, so that
+    searches done at a different moment can be replayed.
+    '''
+    u = urllib.parse.urlsplit(url)
+    service = u.path.rsplit('/', 1)[-1]
+    if exact:
+        return method, service + '?' + u.query
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(u.query) if k not in ('date', 'time')]
+    return method, service + '?' + urllib.parse.urlencode(query)
+
+
+class RecordTransport:
+    '''
+    Performs the requests with another transport, and appends them,
+    with their replies, to a cassette file.
+
+    The cassette has one json object per line, and is compressed if its
+    name ends with .gz.
+
+    Requests with a body, which is where the key is exchanged for a
+    token, are not saved. Neither are the authorization headers.
+    '''
+
+    def __init__(self, path: Path, transport: Transport) -> None:
+        self.path = path
+        self.transport = transport
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def request(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> Response:
+        resp = self.transport.request(method, url, headers, body)
+        if body is not None:
+            return resp
+        entry = {
+            'method': method,
+            'url': url,
+            'status': resp.status,
+            'reason': resp.reason,
+        }
+        try:
+            entry['body'] = resp.body.decode('utf8')
+        except UnicodeDecodeError:
+            import base64
+            entry['body64'] = base64.b64encode(resp.body).decode('ascii')
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock, _cassette_open(self.path, 'a') as f:
+            f.write(line)
+        return resp
+
+
+class ReplayTransport:
+    '''
+    Answers the requests from a cassette written by RecordTransport,
+    without using the network.
+
+    If a request was recorded several times, the replies are returned
+    in order, starting again from the first one at the end.
+    Requests with a different date and time are matched if there is no
+    exact match. Requests that were never recorded raise an exception.
+    '''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._replies: Dict[Tuple[str, str], List[Response]] = {}
+        self._next: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        with _cassette_open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'body64' in entry:
+                    import base64
+                    body = base64.b64decode(entry['body64'])
+                else:
+                    body = entry['body'].encode('utf8')
+                resp = Response(entry['status'], entry['reason'], body)
+                for exact in (True, False):
+                    self._replies.setdefault(_cassette_key(entry['method'], entry['url'], exact), []).append(resp)
+
+    def close(self) -> None:
+        pass
+
+    def request(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> Response:
+        for exact in (True, False):
+            key = _cassette_key(method, url, exact)
+            replies = self._replies.get(key)
+            if replies:
+                with self._lock:
+                    i = self._next.get(key, 0)
+                    self._next[key] = (i + 1) % len(replies)
+                return replies[i]
+        raise Exception(f'Request not in the cassette: {method} {url}')
+
+
+class RateLimiter:
+    '''
+    Token bucket, allowing on average rate requests per second, and
+    bursts of up to burst requests.
+
+    It can be shared by several threads and clients, to keep all of
+    them within the same quota.
+    '''
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        '''
+        Takes a token and returns how many seconds to wait before
+        performing the request.
+
+        When there are no tokens, the waits are queued, so that the
+        requests are spread at the allowed rate.
+        '''
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class CircuitBreaker:
+    '''
+    After failures consecutive requests failed, the API is considered
+    down, and for reset seconds the requests fail immediately instead of
+    waiting for timeouts. Then a single request is let through, to see if
+    the API is back.
+    '''
+
+    def __init__(self, failures: int = 5, reset: float = 30.0) -> None:
+        self.failures = failures
+        self.reset = reset
+        self._count = 0
+        self._opened: Optional[float] = None
+        # A request is testing if the API is back
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self) -> bool:
+        return self._opened is not None
+
+    def allow(self) -> bool:
+        '''
+        Returns True if a request can be performed.
+        '''
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or monotonic() - self._opened < self.reset:
+                return False
+            self._trial = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self) -> None:
+        '''
+        Must be called only for requests that were performed.
+        '''
+        with self._lock:
+            self._count += 1
+            # Requests that were already running when it opened don't
+            # delay the trial
+            if self._trial or (self._opened is None and self._count >= self.failures):
+                self._opened = monotonic()
+            self._trial = False
+
+
+# Replies that are worth retrying, after waiting a bit
+RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+
+
+class Cache:
+    '''
+    Persistent cache of the replies of the API, stored in an sqlite
+    database, so it can be shared by several processes.
+
+    ttl maps the name of a service to the amount of seconds that a reply
+    remains valid. Services that are not in ttl are never cached.
+
+    max_entries is the maximum amount of replies stored. When it is
+    exceeded, the least recently used ones are removed.
+
+    max_stale is the maximum age in seconds of the expired replies that
+    are used when the API fails, None for no limit.
+    '''
+
+    DEFAULT_TTL = {
+        'location.name': 7 * 24 * 3600,
+        'location.nearbystops': 7 * 24 * 3600,
+        # The age is subtracted from the countdowns, but the delays
+        # can change
+        'departureBoard': 60,
+        'arrivalBoard': 60,
+        'trip': 300,
+    }
+
+    def __init__(self, path: Path, ttl: Optional[Dict[str, int]] = None, max_entries: int = 1000, max_stale: Optional[int] = 3600) -> None:
+        self.path = path
+        self.ttl = dict(self.DEFAULT_TTL) if ttl is None else ttl
+        self.max_entries = max_entries
+        self.max_stale = max_stale
+        self._db: Optional['sqlite3.Connection'] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> 'sqlite3.Connection':
+        # The database is opened on first use, so that creating the object
+        # costs nothing when the cache is not needed
+        if self._db is None:
+            import sqlite3
+            db = sqlite3.connect(str(self.path), timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    service TEXT NOT NULL,
+                    param TEXT NOT NULL,
+                    stored REAL NOT NULL,
+                    used REAL NOT NULL,
+                    value BLOB NOT NULL,
+                    PRIMARY KEY (service, param)
+                )''')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+            self._db = db
+        return self._db
+
+    def get(self, service: str, param: str, stale: bool = False) -> Optional[bytes]:
+        '''
+        Returns the cached reply, or None if it is missing or expired.
+
+        If stale is True, expired replies are also returned.
+        '''
+        r = self.lookup(service, param, stale)
+        return None if r is None else r[0]
+
+    def lookup(self, service: str, param: str, stale: bool = False) -> Optional[Tuple[bytes, float]]:
+        '''
+        Same as get(), but also returns the time when the reply was stored.
+
+        With stale, expired replies are returned too, up to max_stale.
+        '''
+        import sqlite3
+        ttl = self.ttl.get(service)
+        if ttl is None:
+            return None
+        now = time()
+        if not stale:
+            oldest = now - ttl
+        elif self.max_stale is not None:
+            oldest = now - max(ttl, self.max_stale)
+        else:
+            oldest = float('-inf')
+        try:
+            with self._lock:
+                db = self._connect()
+                row = db.execute(
+                    'SELECT value, stored FROM cache WHERE service = ? AND param = ? AND stored > ?',
+                    (service, param, oldest)
+                ).fetchone()
+                if row is None:
+                    return None
+                db.execute('UPDATE cache SET used = ? WHERE service = ? AND param = ?', (now, service, param))
+        except sqlite3.Error:
+            # A broken or busy cache is just a miss
+            return None
+        return row[0], row[1]
+
+    def put(self, service: str, param: str, value: bytes) -> None:
+        '''
+        Stores a reply, evicting the least recently used ones if needed.
+        '''
+        import sqlite3
+        if service not in self.ttl:
+            return
+        now = time()
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    db.execute(
+                        'INSERT OR REPLACE INTO cache (service, param, stored, used, value) VALUES (?, ?, ?, ?, ?)',
+                        (service, param, now, now, value)
+                    )
+                    count = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+                    if count > self.max_entries:
+                        db.execute(
+                            'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY used LIMIT ?)',
+                            (count - self.max_entries,)
+                        )
+                    db.execute('COMMIT')
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error:
+            pass
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connect().execute('DELETE FROM cache')
+
+
 class Vasttrafik:
 
-    def __init__(self, key: str, tokenfile: Path, api: str = "api.vasttrafik.se/bin/rest.exe/v2") -> None:
+    def __init__(self, key: str, tokenfile: Path, api: str = "api.vasttrafik.se/bin/rest.exe/v2", pool_size: int = 4, timeout: float = 10.0, cache: Optional[Cache] = None, stopindex: Optional['StopIndex'] = None, transport: Optional[Transport] = None, limiter: Optional[RateLimiter] = None, retries: int = 2, backoff: float = 0.5, breaker: Optional[CircuitBreaker] = None) -> None:
         '''
         key is the API key that must be sent on every request to obtain a reply.
         you can obtain one at api.vasttrafik.se, but it will be activated the
         night after registration.
+
+        pool_size is the amount of persistent connections to keep open.
+        timeout is the network timeout, in seconds.
+
+        cache is used to avoid repeating requests whose reply does not
+        change often, such as the stop names.
+
+        stopindex collects all the stops obtained from the API, and is
+        used to find them without network when offline=True is passed.
+
+        transport performs the HTTP requests. By default it is an
+        HTTPPool with pool_size and timeout.
+
+        limiter, if set, limits the rate of the requests.
+
+        Requests failing because of the network or with a 429 or 5xx
+        status are tried again up to retries times, waiting a random time
+        up to backoff seconds, doubled at every attempt.
+
+        breaker makes the requests fail immediately while the API is down.
+        The cached replies are then used even if expired, when present.
+
+        The functions in hooks are called with an Event for every
+        request, cache lookup, decoding and so on. They can be called
+        from several threads at once. Stats collects them.
         '''
         self.key = key
         self.api = api
         self.datetime_obj: Optional[datetime.datetime] = None
-        self._tokenfile = tokenfile
-        self._token: Optional[Token] = None
+        self.hooks: List[Hook] = []
+        self._tokens = TokenManager(tokenfile, self._renew_token)
+        self.transport: Transport = transport if transport is not None else HTTPPool(pool_size, timeout, hooks=self.hooks)
+        self.cache = cache
+        self.stopindex = stopindex
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # Board requests currently being performed, to share their reply
+        self._inflight: Dict[tuple, 'Future'] = {}
+        self._inflight_lock = threading.Lock()
+
+    def emit(self, event: Event) -> None:
+        '''
+        Calls the hooks with the event.
+        '''
+        for hook in self.hooks:
+            hook(event)
 
     def _get_token(self) -> Token:
-        # Attempt to get cached token
-        if self._token is None and self._tokenfile.exists():
-            with self._tokenfile.open('rt') as f:
-                self._token = load(json.load(f), Token)
-
-        # If there is a token but it's expired, null it
-        if self._token and self._token.expired():
-            self._token = None
+        return self._tokens.get()
 
-        if self._token is None:
-            self._token = self._renew_token()
+    def _warm_token(self) -> None:
+        '''
+        Obtains the token once before starting the threads that perform
+        the requests, rather than in every thread.
 
-            with self._tokenfile.open('wt') as f:
-                json.dump(dump(self._token), f)
-        return self._token
+        Errors are ignored, the requests handle them one by one.
+        '''
+        if isinstance(self.transport, ReplayTransport):
+            # Recorded replies need no token
+            return
+        try:
+            self._get_token()
+        except Exception:
+            pass
 
     def _renew_token(self) -> Token:
         url = f'https://api.vasttrafik.se:443/token'
-        req = urllib.request.Request(url)
-        req.data = b'grant_type=client_credentials'
-        req.headers['Authorization'] = 'Basic ' + self.key
-        with urllib.request.urlopen(req) as f:
-            r = load(json.load(f), Token)
+        start = perf_counter()
+        resp = self.transport.request(
+            'POST',
+            url,
+            {'Authorization': 'Basic ' + self.key},
+            b'grant_type=client_credentials',
+        )
+        if resp.status != 200:
+            raise Exception(f'Unable to obtain token: {resp.status} {resp.reason}')
+        r = load(json.loads(resp.body), Token)
         r.expires_in += int(time())
+        if self.hooks:
+            self.emit(Event('token', 'token', perf_counter() - start, len(resp.body)))
         return r
 
-    def _request(self, service, param):
-        token = self._get_token().access_token
+    def _url(self, service: str, param: str) -> str:
+        return "https://%s/%s?format=json&%s" % (self.api, service, param)
 
-        url = "https://%s/%s?format=json&%s" % (
-            self.api, service, param)
-        req = urllib.request.Request(url)
-        req.headers['Authorization'] = 'Bearer ' + token
-        r = b''
-        with urllib.request.urlopen(req) as f:
-            while True:
-                l = f.read()
-                if len(l) == 0:
-                    break
-                r += l
+    def _cached(self, service: str, param: str, refresh: bool) -> Optional[Tuple[Any, float]]:
+        '''
+        Returns the decoded cached reply and its age in seconds, or None.
+        '''
+        if self.cache is not None and not refresh:
+            cached = self.cache.lookup(service, param)
+            if self.hooks and service in self.cache.ttl:
+                self.emit(Event('cache', service, hit=cached is not None))
+            if cached is not None:
+                return self._json(service, cached[0]), max(time() - cached[1], 0)
+        return None
+
+    def _json(self, service: str, data: bytes):
+        if not self.hooks:
+            return json_loads(data)
+        start = perf_counter()
+        r = json_loads(data)
+        self.emit(Event('decode', service, perf_counter() - start, len(data)))
+        return r
+
+    def _parse(self, service: str, parse: Callable, *args):
+        '''
+        Calls one of the _parse functions, measuring it.
+        '''
+        if not self.hooks:
+            return parse(*args)
+        start = perf_counter()
+        r = parse(*args)
+        self.emit(Event('parse', service, perf_counter() - start))
+        return r
+
+    def _decode(self, service: str, param: str, resp: Response):
+        '''
+        Checks the reply from the API, decodes it and caches it.
+        '''
+        r = resp.body
 
-        if r.strip().startswith(b'Invalid authKey'):
+        if r.lstrip().startswith(b'Invalid authKey'):
             raise Exception('Invalid authKey')
+        if resp.status != 200:
+            raise Exception(f'HTTP error {resp.status} {resp.reason}')
 
-        return json.loads(r.decode('utf8'))
+        decoded = self._json(service, r)
+        if self.cache is not None:
+            self.cache.put(service, param, r)
+        return decoded
 
-    def location(self, user_input) -> Stops:
-        '''Returns a list of Stop objects, completing from the user input'''
-        a = self._request(
-            "location.name", urllib.parse.urlencode({'input': user_input}))
-        c = a["LocationList"]['StopLocation']
+    def _request(self, service, param, refresh=False):
+        '''
+        Performs a request to the API and returns the decoded json.
 
-        if isinstance(c, dict):
-            c = [c]
-        return load(c, Stops)
+        If refresh is True, the cache is not read, but the reply is
+        still stored in it.
+        '''
+        return self._request_aged(service, param, refresh)[0]
 
-    def nearby(self, lat: float, lon: float, stops: int = 10, dist: Optional[int] = None) -> Stops:
+    def _request_aged(self, service: str, param: str, refresh: bool = False) -> Tuple[Any, float]:
         '''
-        Returns the list of stops close to a certain location
+        Same as _request(), but also returns the age of the reply in
+        seconds, if it comes from the cache.
+        '''
+        cached = self._cached(service, param, refresh)
+        if cached is not None:
+            return cached
+
+        if not self.breaker.allow():
+            return self._stale(service, param, Exception('The API is not responding, not trying for now'))
+        try:
+            resp = self._attempts(service, param)
+        except Exception as e:
+            self.breaker.failure()
+            return self._stale(service, param, e)
+        self.breaker.success()
+        return self._decode(service, param, resp), 0.0
+
+    def _attempts(self, service: str, param: str) -> Response:
+        '''
+        Performs the request, trying again if it fails in a way that
+        might be temporary.
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._wait('retry', service, self._retry_delay(attempt))
+            if self.limiter is not None:
+                self._wait('throttle', service, self.limiter.reserve())
+
+            if isinstance(self.transport, ReplayTransport):
+                # Recorded replies need no token
+                token = ''
+            else:
+                token = self._get_token().access_token
+            start = perf_counter()
+            try:
+                resp = self.transport.request('GET', self._url(service, param), {'Authorization': 'Bearer ' + token})
+            except OSError:
+                if attempt == self.retries:
+                    raise
+                continue
+            if self.hooks:
+                self.emit(Event('request', service, perf_counter() - start, len(resp.body)))
+            if resp.status not in RETRY_STATUS:
+                return resp
+        raise Exception(f'HTTP error {resp.status} {resp.reason}')
+
+    def _retry_delay(self, attempt: int) -> float:
+        '''
+        Random, so that clients failing together don't retry together.
+        '''
+        import random
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
 
-        lat = latitude
-        lon = longitude
+    def _wait(self, kind: str, service: str, seconds: float) -> None:
+        if seconds > 0:
+            if self.hooks:
+                self.emit(Event(kind, service, seconds))
+            sleep(seconds)
 
-        stops = maximum number of stops to return
-        dist = maximum distance in meters
+    def _stale(self, service: str, param: str, error: Exception) -> Tuple[Any, float]:
+        '''
+        Returns the cached reply even if expired, and its age, or raises
+        error.
         '''
+        cached = self.cache.lookup(service, param, stale=True) if self.cache is not None else None
+        if self.hooks and self.cache is not None and service in self.cache.ttl:
+            self.emit(Event('stale', service, hit=cached is not None))
+        if cached is None:
+            raise error
+        return self._json(service, cached[0]), max(time() - cached[1], 0)
+
+    @staticmethod
+    def _location_query(user_input) -> Tuple[str, str]:
+        return "location.name", urllib.parse.urlencode({'input': user_input})
+
+    @staticmethod
+    def _nearby_query(lat: float, lon: float, stops: int, dist: Optional[int]) -> Tuple[str, str]:
         params = 'originCoordLat=%s&originCoordLong=%s&maxNo=%d' % (
             str(lat), str(lon), stops)
         if dist is not None:
             params += '&maxDist=%d' % dist
+        return 'location.nearbystops', params
 
-        b = self._request('location.nearbystops', params)
+    @staticmethod
+    def _parse_stops(b) -> Stops:
         c = b["LocationList"]['StopLocation']
 
-        return load(c, Stops)
+        if isinstance(c, dict):
+            c = [c]
+        return load_stops(c)
+
+    def _harvest(self, stops: Stops) -> Stops:
+        if self.stopindex is not None:
+            self.stopindex.add(stops)
+        return stops
+
+    def location(self, user_input, refresh=False, offline=False) -> Stops:
+        '''Returns a list of Stop objects, completing from the user input
+
+        refresh = ignore the cached results
+        offline = search the stop index first, and only use the network
+            if nothing is found there'''
+        if offline and self.stopindex is not None:
+            r = self.stopindex.search(user_input)
+            if self.hooks:
+                self.emit(Event('stopindex', 'location.name', hit=bool(r)))
+            if r:
+                return r
+        service, params = self._location_query(user_input)
+        return self._harvest(self._parse(service, self._parse_stops, self._request(service, params, refresh)))
+
+    def stop(self, user_input, refresh=False, offline=False) -> Stop:
+        '''Returns the Stop best matching the user input
+
+        refresh = ignore the cached results
+        offline = use the stop index if the input names exactly one
+            stop there, otherwise ask the API'''
+        if offline and self.stopindex is not None:
+            r = self.stopindex.find(user_input)
+            if self.hooks:
+                self.emit(Event('stopindex', 'location.name', hit=r is not None))
+            if r is not None:
+                return r
+        return self.location(user_input, refresh)[0]
+
+    def nearby(self, lat: float, lon: float, stops: int = 10, dist: Optional[int] = None, refresh: bool = False, offline: bool = False) -> Stops:
+        '''
+        Returns the list of stops close to a certain location
 
-    def board(self, id, direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None) -> List['BoardItem']:
-        '''Returns an arrival/departure board for a given station'''
+        lat = latitude
+        lon = longitude
 
+        stops = maximum number of stops to return
+        dist = maximum distance in meters
+
+        refresh = ignore the cached results
+        offline = search the stop index first, and only use the network
+            if nothing is found there
+        '''
+        if offline and self.stopindex is not None:
+            r = self.stopindex.nearby(lat, lon, stops, dist)
+            if self.hooks:
+                self.emit(Event('stopindex', 'location.nearbystops', hit=bool(r)))
+            if r:
+                return r
+        service, params = self._nearby_query(lat, lon, stops, dist)
+        return self._harvest(self._parse(service, self._parse_stops, self._request(service, params, refresh)))
+
+    @staticmethod
+    def _board_query(id, direction, arrival, time_span, departures, datetime_obj) -> Tuple[str, str]:
         if arrival:
             service = 'arrivalBoard'
         else:
@@ -192,52 +1150,192 @@ class Vasttrafik:
                 datetime_obj.year, datetime_obj.month, datetime_obj.day)
             params['time'] = '%02d:%02d' % (
                 datetime_obj.hour, datetime_obj.minute)
+        return service, urllib.parse.urlencode(params)
 
-        b = self._request(service, urllib.parse.urlencode(params))
+    @staticmethod
+    def _board_reply(b, arrival) -> Tuple[datetime.datetime, List[Dict[str, Any]]]:
+        '''
+        Returns the server time and the undecoded items of the board.
+        '''
         if arrival:
             c = b['ArrivalBoard']['Arrival']
-            self.datetime_obj = to_datetime(
+            servertime = to_datetime(
                 b['ArrivalBoard']['serverdate'], b['ArrivalBoard']['servertime'])
         else:
             c = b['DepartureBoard']['Departure']
-            self.datetime_obj = to_datetime(
+            servertime = to_datetime(
                 b['DepartureBoard']['serverdate'], b['DepartureBoard']['servertime'])
 
         if not isinstance(c, list):
             c = [c]
+        return servertime, c
 
-        trams = load(c, List[BoardItem])
+    @staticmethod
+    def _parse_board_items(b, arrival) -> Tuple[datetime.datetime, List['BoardItem']]:
+        '''
+        Returns the server time and the items of the board, one per
+        departure.
+        '''
+        servertime, c = Vasttrafik._board_reply(b, arrival)
+        return servertime, load_board_items(c)
 
-        # Group similar ones
-        i = 0
-        while i < len(trams) - 1:
-            j = i + 1
-            while j < len(trams):
-                if trams[i].join(trams[j]):
-                    trams.pop(j)
-                else:
-                    j += 1
-            i += 1
+    @staticmethod
+    def _group_board(items: List['BoardItem']) -> List['BoardItem']:
+        '''
+        Groups similar items into a copy of the first of them, and sorts
+        them by track. The items passed are not modified.
+        '''
+        groups: Dict[Tuple[str, str, Optional[str]], BoardItem] = {}
+        copied: Set[Tuple[str, str, Optional[str]]] = set()
+        for tram in items:
+            key = (tram.name, tram.stopid, tram.direction)
+            first = groups.get(key)
+            if first is None:
+                groups[key] = tram
+                continue
+            if key not in copied:
+                first = groups[key] = copy.copy(first)
+                first.datetime_obj = list(first.datetime_obj)
+                copied.add(key)
+            first.join(tram)
+        trams = list(groups.values())
 
         # Sort by track
         trams.sort(key=lambda x: (x.track, x.datetime_obj[0]))
         return trams
 
-    def trip(self, originCoord=None, originId=None, originCoordName=None, destCoord=None, destId=None, destCoordName=None, viaId=None, datetime_obj=None) -> 'Trips':
+    @staticmethod
+    def _parse_board(b, arrival) -> Tuple[datetime.datetime, List['BoardItem']]:
         '''
-        originCoord = a tuple with origin coordinates (lat,lon)
-        originId = stop id
-        originCoordName = address
+        Returns the server time and the grouped items of the board.
+        '''
+        servertime, items = Vasttrafik._parse_board_items(b, arrival)
+        return servertime, Vasttrafik._group_board(items)
 
-        destCoord
-        destId
-        destCoordName
+    def _board(self, id, direction, arrival, time_span, departures, datetime_obj, refresh=False) -> 'Board':
+        '''
+        Returns the board. If an identical request is already being
+        performed by another thread, its reply is used instead of
+        performing a new one.
 
-        viaId = pass by a certain stop
+        A board from the cache has the server time moved ahead by its
+        age, and the departures already gone removed.
+        '''
+        service, params = self._board_query(id, direction, arrival, time_span, departures, datetime_obj)
+        key: tuple = (service, params)
+        if datetime_obj is None:
+            # Without a time, the board depends on the current minute
+            key += (int(time() // 60),)
+
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if future is None:
+                from concurrent.futures import Future
+                future = self._inflight[key] = Future()
+
+        if self.hooks:
+            self.emit(Event('coalesced', service, hit=not owner))
+        if not owner:
+            r = future.result()
+            return r._replace(items=list(r.items))
+
+        try:
+            reply, age = self._request_aged(service, params, refresh)
+            if self.hooks and not age:
+                # The hooks get the departures before grouping them
+                servertime, items = self._parse(service, self._parse_board_items, reply, arrival)
+                self.emit(Event('board', str(id), data=Board(servertime, items)))
+                r = Board(servertime, self._group_board(items))
+            else:
+                r = Board(*self._parse(service, self._parse_board, reply, arrival))
+            if age:
+                servertime = r.servertime + datetime.timedelta(seconds=int(age))
+                r = Board(servertime, upcoming(servertime, r.items), age)
+            future.set_result(r)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+        return r._replace(items=list(r.items))
+
+    def board(self, id, direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None, refresh=False) -> List['BoardItem']:
+        '''Returns an arrival/departure board for a given station
+
+        refresh = ignore the cached board'''
+        r = self._board(id, direction, arrival, time_span, departures, datetime_obj, refresh)
+        self.datetime_obj = r.servertime
+        return r.items
+
+    def iter_board(self, id, direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None, refresh=False) -> Iterator['BoardItem']:
+        '''
+        Same as board(), but the items are created one at a time, while
+        iterating. They are not grouped, every item has one departure,
+        in the order of the reply.
 
-        datetime_obj = search from this moment
+        The request is performed, and datetime_obj set, before returning.
+        '''
+        service, params = self._board_query(id, direction, arrival, time_span, departures, datetime_obj)
+        reply, age = self._request_aged(service, params, refresh)
+        servertime, c = self._board_reply(reply, arrival)
+        servertime += datetime.timedelta(seconds=int(age))
+        self.datetime_obj = servertime
+        items = iter_board_items(c)
+        if age:
+            return (i for i in items if i.datetime_obj[0] >= servertime)
+        return items
+
+    def cached_board(self, id, direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None, max_age=None) -> Optional[Tuple['Board', float]]:
+        '''
+        Returns the board stored in the cache, even if expired, and its
+        age in seconds, without performing any request. None if it is
+        not cached, or older than max_age seconds.
+
+        As for the cached boards returned by board(), the server time is
+        moved ahead by the age and the departures already gone are
+        removed.
+        '''
+        if self.cache is None:
+            return None
+        service, params = self._board_query(id, direction, arrival, time_span, departures, datetime_obj)
+        cached = self.cache.lookup(service, params, stale=True)
+        if cached is None:
+            return None
+        age = max(time() - cached[1], 0)
+        if max_age is not None and age > max_age:
+            return None
+        servertime, items = self._parse(service, self._parse_board, self._json(service, cached[0]), arrival)
+        servertime += datetime.timedelta(seconds=int(age))
+        return Board(servertime, upcoming(servertime, items), age), age
+
+    def board_many(self, ids: Iterable[str], direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None, workers: int = 8, refresh=False) -> Dict[str, Union['Board', Exception]]:
         '''
+        Returns the boards of several stations, requested concurrently
+        using at most workers threads.
 
+        The result maps every id to its Board, or to the exception
+        raised while obtaining it.
+
+        The other parameters are the same as board()
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        ids = list(dict.fromkeys(ids))
+        self._warm_token()
+
+        def get(id: str) -> Union[Board, Exception]:
+            try:
+                return self._board(id, direction, arrival, time_span, departures, datetime_obj, refresh)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ids)))) as executor:
+            return dict(zip(ids, executor.map(get, ids)))
+
+    @staticmethod
+    def _trip_query(originCoord, originId, originCoordName, destCoord, destId, destCoordName, viaId, datetime_obj) -> Tuple[str, str]:
         service = 'trip'
         params = {}
 
@@ -265,14 +1363,140 @@ class Vasttrafik:
                 datetime_obj.year, datetime_obj.month, datetime_obj.day)
             params['time'] = '%02d:%02d' % (
                 datetime_obj.hour, datetime_obj.minute)
+        return service, urllib.parse.urlencode(params)
 
-        # Request
-        b = self._request(service, urllib.parse.urlencode(params))
+    @staticmethod
+    def _parse_trip(b) -> Tuple[datetime.datetime, 'Trips']:
         c = b['TripList']
+        return to_datetime(c['serverdate'], c['servertime']), load_trips(c['Trip'])
+
+    def trip(self, originCoord=None, originId=None, originCoordName=None, destCoord=None, destId=None, destCoordName=None, viaId=None, datetime_obj=None, refresh=False) -> 'Trips':
+        '''
+        originCoord = a tuple with origin coordinates (lat,lon)
+        originId = stop id
+        originCoordName = address
+
+        destCoord
+        destId
+        destCoordName
 
-        self.datetime_obj = to_datetime(c['serverdate'], c['servertime'])
+        viaId = pass by a certain stop
+
+        datetime_obj = search from this moment
+
+        refresh = ignore the cached trips. The cached ones that already
+            departed are removed.
+        '''
+        service, params = self._trip_query(originCoord, originId, originCoordName, destCoord, destId, destCoordName, viaId, datetime_obj)
+        reply, age = self._request_aged(service, params, refresh)
+        self.datetime_obj, trips = self._parse(service, self._parse_trip, reply)
+        if age:
+            self.datetime_obj += datetime.timedelta(seconds=int(age))
+            trips = [i for i in trips if i.legs and i.departure >= self.datetime_obj]
+        return trips
+
+    def iter_trip(self, originCoord=None, originId=None, originCoordName=None, destCoord=None, destId=None, destCoordName=None, viaId=None, datetime_obj=None, refresh=False) -> Iterator['Trip']:
+        '''
+        Same as trip(), but the trips are created one at a time, while
+        iterating.
 
-        return load(c['Trip'], Trips)
+        The request is performed, and datetime_obj set, before returning.
+        '''
+        service, params = self._trip_query(originCoord, originId, originCoordName, destCoord, destId, destCoordName, viaId, datetime_obj)
+        reply, age = self._request_aged(service, params, refresh)
+        c = reply['TripList']
+        servertime = to_datetime(c['serverdate'], c['servertime']) + datetime.timedelta(seconds=int(age))
+        self.datetime_obj = servertime
+        trips = iter_trips(c['Trip'])
+        if age:
+            return (i for i in trips if i.legs and i.departure >= servertime)
+        return trips
+
+    def prefetch(self, boards: Iterable[str] = (), trips: Iterable[Tuple[str, str]] = (), time_span=None, departures=2, workers: int = 8) -> int:
+        '''
+        Requests again the boards of the stop ids in boards, and the
+        trips between the (originId, destId) pairs in trips, so that
+        the cache has them fresh.
+
+        They are found in the cache only if later requested with the
+        same parameters, and no time.
+
+        Returns how many requests failed.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        queries = [self._board_query(i, None, False, time_span, departures, None) for i in boards]
+        queries += [self._trip_query(None, o, None, None, d, None, None, None) for o, d in trips]
+        if not queries:
+            return 0
+        self._warm_token()
+
+        def get(query: Tuple[str, str]) -> bool:
+            try:
+                self._request(*query, refresh=True)
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(queries)))) as executor:
+            return list(executor.map(get, queries)).count(False)
+
+    def trip_search(self, originCoord=None, originId=None, originCoordName=None, destCoord=None, destId=None, destCoordName=None, viaIds: Iterable[Optional[str]] = (None,), datetime_obj=None, window: datetime.timedelta = datetime.timedelta(hours=2), step: datetime.timedelta = datetime.timedelta(minutes=15), workers: int = 8) -> 'Trips':
+        '''
+        Searches the trips leaving during a time window, and passing by
+        any of the via stops.
+
+        A query is performed every step from datetime_obj (now by default)
+        until the end of the window, for every stop in viaIds. None in
+        viaIds means no via stop. The queries are performed concurrently
+        using at most workers threads.
+
+        The same trip found by several queries is returned once. The
+        trips are sorted by arrival time.
+
+        Queries that fail are ignored, unless all of them fail.
+        step must be positive.
+
+        The other parameters are the same as trip()
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        if step <= datetime.timedelta(0):
+            raise Exception(f'The step must be positive: {step}')
+        start = datetime_obj if datetime_obj is not None else datetime.datetime.now()
+        times = [start]
+        while times[-1] + step < start + window:
+            times.append(times[-1] + step)
+        queries = [
+            self._trip_query(originCoord, originId, originCoordName, destCoord, destId, destCoordName, via, t)
+            for via in dict.fromkeys(viaIds)
+            for t in times
+        ]
+        self._warm_token()
+
+        def get(query: Tuple[str, str]) -> Union[Tuple[datetime.datetime, Trips], Exception]:
+            try:
+                return self._parse(query[0], self._parse_trip, self._request(*query))
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(queries)))) as executor:
+            results = list(executor.map(get, queries))
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        if len(errors) == len(results):
+            raise errors[0]
+
+        found: Dict[tuple, Trip] = {}
+        for r in results:
+            if isinstance(r, Exception):
+                continue
+            servertime, trips = r
+            self.datetime_obj = max(servertime, self.datetime_obj or servertime)
+            for trip in trips:
+                if trip.legs:
+                    found.setdefault(trip.key, trip)
+        return sorted(found.values(), key=lambda t: (t.arrival, t.departure))
 
 
 class LegHalf(NamedTuple):
@@ -287,7 +1511,7 @@ class LegHalf(NamedTuple):
     rtTime: Optional[str] = None
 
     @property
-    def datetime_obj(self):
+    def datetime_obj(self) -> datetime.datetime:
         d = self.rtDate if self.rtDate else self.date
         t = self.rtTime if self.rtTime else self.time
         return to_datetime(d, t)
@@ -357,16 +1581,18 @@ class Leg(NamedTuple):
         '''
         Returns a pretty printed string representing the Leg of the trip.
         '''
+        origin = self.Origin.datetime_obj
+        destination = self.Destination.datetime_obj
         return '%s %0*d:%0*d\t%0*d:%0*d\t%s -> %s ' % (
             self.getName(color),
             2,
-            self.Origin.datetime_obj.hour,
+            origin.hour,
             2,
-            self.Origin.datetime_obj.minute,
+            origin.minute,
             2,
-            self.Destination.datetime_obj.hour,
+            destination.hour,
             2,
-            self.Destination.datetime_obj.minute,
+            destination.minute,
             self.Origin.name,
             self.Destination.name
         )
@@ -393,15 +1619,9 @@ class Leg(NamedTuple):
 
         name += self.type.symbol
 
-        while ulen(name) < 33:
-            name = ' ' + name
-
         if not color:
-            return name
-
-        fgcolor = int('0x' + self.fgColor[1:], 16)
-        bgcolor = int('0x' + self.bgColor[1:], 16)
-        return colorize(name, fgcolor, bg=bgcolor)
+            return name_cell(name, 33)
+        return name_cell(name, 33, self.fgColor, self.bgColor)
 
 
 Legs = List[Leg]
@@ -425,6 +1645,25 @@ class Trip(NamedTuple):
             return [self.Leg]
         return self.Leg
 
+    @property
+    def departure(self) -> datetime.datetime:
+        return self.legs[0].Origin.datetime_obj
+
+    @property
+    def arrival(self) -> datetime.datetime:
+        return self.legs[-1].Destination.datetime_obj
+
+    @property
+    def key(self) -> tuple:
+        '''
+        Identifies the itinerary: the same vehicles between the same
+        stops at the same times.
+        '''
+        return tuple(
+            (i.name, i.Origin.id, i.Origin.datetime_obj, i.Destination.id, i.Destination.datetime_obj)
+            for i in self.legs
+        )
+
     def toTerm(self):
         return self.toTxt(True)
 
@@ -448,7 +1687,11 @@ class Accessibility(Enum):
         return ''
 
 
-@dataclass
+# Slots make instances smaller, but are only supported from 3.10
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_SLOTS)
 class BoardItem:
 
     '''
@@ -492,6 +1735,13 @@ class BoardItem:
         return self._rttrack if self._rttrack else self._track
 
     def __post_init__(self):
+        # The same names repeat on every departure, share the strings
+        self.name = sys.intern(self.name)
+        self.sname = sys.intern(self.sname)
+        self.stop = sys.intern(self.stop)
+        self.stopid = sys.intern(self.stopid)
+        if self.direction is not None:
+            self.direction = sys.intern(self.direction)
         self.datetime_obj = [to_datetime(self.date, self.time)]
 
     def join(self, o: 'BoardItem') -> bool:
@@ -537,13 +1787,406 @@ class BoardItem:
         if self.night:
             name += u"☾ "
 
-        while ulen(name) < 20:
-            name = " " + name
-
         if not color:
-            return name
+            return name_cell(name, 20)
+        return name_cell(name, 20, self.fgcolor, self.bgcolor)
 
-        fgcolor = int('0x' + self.fgcolor[1:], 16)
-        bgcolor = int('0x' + self.bgcolor[1:], 16)
-        return colorize(name, fgcolor, bg=bgcolor)
 
+def upcoming(servertime: datetime.datetime, items: List[BoardItem]) -> List[BoardItem]:
+    '''
+    Removes the departures that are in the past, and the vehicles
+    that have none left.
+    '''
+    r = []
+    for i in items:
+        left = [d for d in i.datetime_obj if d >= servertime]
+        if len(left) == len(i.datetime_obj):
+            r.append(i)
+        elif left:
+            i = copy.copy(i)
+            i.datetime_obj = left
+            r.append(i)
+    return r
+
+
+
+# Decoders for the replies of the API.
+#
+# They build the objects directly, doing the same conversions that
+# typedload would do. Anything unexpected is left to typedload, which
+# also gives the meaningful error messages.
+
+_DECODE_ERRORS = (KeyError, TypeError, ValueError, AttributeError)
+
+
+def _str(v: Any) -> Optional[str]:
+    return None if v is None else str(v)
+
+
+def load_stops(c: Any) -> Stops:
+    try:
+        return [
+            Stop(str(i['id']), float(i['lon']), float(i['lat']), str(i['name']), _str(i.get('idx')))
+            for i in c
+        ]
+    except _DECODE_ERRORS:
+        return load(c, Stops)
+
+
+def _load_board_item(i: Dict[str, Any]) -> BoardItem:
+    return BoardItem(
+        name=str(i['name']),
+        sname=str(i['sname']),
+        vehicle_type=VehicleType(i['type']),
+        stop=str(i['stop']),
+        stopid=str(i['stopid']),
+        direction=_str(i['direction']),
+        _time=str(i['time']),
+        _date=str(i['date']),
+        _track=str(i['track']),
+        _rtdate=_str(i.get('rtDate')),
+        _rttime=_str(i.get('rtTime')),
+        _rttrack=_str(i.get('rtTrack')),
+        accessibility=Accessibility(i.get('accessibility')),
+        night=_str(i.get('night')),
+        bgcolor=str(i.get('bgColor', '#000000')),
+        fgcolor=str(i.get('fgColor', '#ffffff')),
+    )
+
+
+def load_board_items(c: Any) -> List[BoardItem]:
+    try:
+        return [_load_board_item(i) for i in c]
+    except _DECODE_ERRORS:
+        return load(c, List[BoardItem])
+
+
+def iter_board_items(c: Any) -> Iterator[BoardItem]:
+    '''
+    Same as load_board_items, but builds the items one at a time.
+    '''
+    for i in c:
+        try:
+            yield _load_board_item(i)
+        except _DECODE_ERRORS:
+            yield load(i, BoardItem)
+
+
+def _load_leghalf(i: Dict[str, Any]) -> LegHalf:
+    return LegHalf(
+        date=str(i['date']),
+        id=str(i['id']),
+        name=str(i['name']),
+        time=str(i['time']),
+        type=str(i['type']),
+        track=str(i.get('track', '')),
+        routeIdx=_str(i.get('routeIdx')),
+        rtDate=_str(i.get('rtDate')),
+        rtTime=_str(i.get('rtTime')),
+    )
+
+
+def _load_leg(i: Dict[str, Any]) -> Leg:
+    return Leg(
+        name=str(i['name']),
+        type=VehicleType(i['type']),
+        Origin=_load_leghalf(i['Origin']),
+        Destination=_load_leghalf(i['Destination']),
+        accessibility=str(i.get('accessibility', '')),
+        sname=_str(i.get('sname')),
+        track=_str(i.get('track')),
+        rtDate=_str(i.get('rtDate')),
+        rtTime=_str(i.get('rtTime')),
+        rtTrack=_str(i.get('rtTrack')),
+        direction=_str(i.get('direction')),
+        stroke=_str(i.get('stroke')),
+        id=_str(i.get('id')),
+        bgColor=str(i.get('bgColor', '#0000ff')),
+        fgColor=str(i.get('fgColor', '#ffffff')),
+        night=bool(i.get('night', False)),
+    )
+
+
+def _load_trip(i: Dict[str, Any]) -> Trip:
+    legs = i['Leg']
+    if isinstance(legs, list):
+        return Trip([_load_leg(j) for j in legs])
+    return Trip(_load_leg(legs))
+
+
+def load_trips(c: Any) -> Trips:
+    try:
+        if not isinstance(c, list):
+            raise TypeError()
+        return [_load_trip(i) for i in c]
+    except _DECODE_ERRORS:
+        return load(c, Trips)
+
+
+def iter_trips(c: Any) -> Iterator[Trip]:
+    '''
+    Same as load_trips, but builds the trips one at a time.
+    '''
+    if not isinstance(c, list):
+        yield from load(c, Trips)
+        return
+    for i in c:
+        try:
+            yield _load_trip(i)
+        except _DECODE_ERRORS:
+            yield load(i, Trip)
+
+
+class Board(NamedTuple):
+    '''
+    The board of a station, with the time of the server when it was
+    obtained.
+
+    age is the amount of seconds since it was obtained, if it comes from
+    the cache. The server time is already moved ahead by it.
+    '''
+    servertime: datetime.datetime
+    items: List[BoardItem]
+    age: float = 0.0
+
+
+class AsyncHTTPPool:
+    '''
+    asyncio version of HTTPPool.
+
+    It keeps persistent HTTPS connections, and must only be used from
+    the event loop that created them.
+    '''
+
+    def __init__(self, size: int = 4, timeout: float = 10.0, context: Optional['ssl.SSLContext'] = None) -> None:
+        import ssl
+        self.size = size
+        self.timeout = timeout
+        self._context = context if context is not None else ssl.create_default_context()
+        self._idle: Dict[str, List[Tuple['asyncio.StreamReader', 'asyncio.StreamWriter']]] = {}
+
+    async def close(self) -> None:
+        idle = self._idle
+        self._idle = {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+
+    @staticmethod
+    async def _read_response(reader: 'asyncio.StreamReader') -> Tuple[Response, Dict[str, str], bool]:
+        '''
+        Reads a complete reply. Returns the reply, its headers and
+        whether the connection can be reused.
+        '''
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed')
+        _, status, reason = status_line.decode('latin1').rstrip('\r\n').split(' ', 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, v = line.decode('latin1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if size == 0:
+                    # Trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        return Response(int(status), reason, data), headers, keep_alive
+
+    async def request(self, method: str, url: str, headers: Dict[str, str], body: Optional[bytes] = None) -> Response:
+        '''
+        Performs a request and returns the complete, decompressed, body.
+        '''
+        import asyncio
+        import gzip
+
+        u = urllib.parse.urlsplit(url)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        host = u.hostname or ''
+        port = u.port or 443
+
+        headers = dict(headers)
+        headers['Host'] = u.netloc
+        headers['Accept-Encoding'] = 'gzip'
+        if body is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+            headers['Content-Length'] = str(len(body))
+        raw = f'{method} {path} HTTP/1.1\r\n'.encode('ascii')
+        raw += ''.join(f'{k}: {v}\r\n' for k, v in headers.items()).encode('latin1')
+        raw += b'\r\n' + (body or b'')
+
+        while True:
+            idle = self._idle.get(u.netloc)
+            reused = bool(idle)
+            if idle:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=self._context, server_hostname=host),
+                    self.timeout,
+                )
+            try:
+                writer.write(raw)
+                await writer.drain()
+                resp, resp_headers, keep_alive = await asyncio.wait_for(self._read_response(reader), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server closed an idle connection, try a fresh one
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        conns = self._idle.setdefault(u.netloc, [])
+        if keep_alive and len(conns) < self.size:
+            conns.append((reader, writer))
+        else:
+            writer.close()
+
+        if resp_headers.get('content-encoding') == 'gzip':
+            resp = resp._replace(body=gzip.decompress(resp.body))
+        return resp
+
+
+class AsyncVasttrafik:
+    '''
+    asyncio version of Vasttrafik.
+
+    It has the same methods, but they are coroutines. Parsing, token
+    and cache handling are shared with Vasttrafik.
+
+    concurrency is the maximum amount of requests that are performed
+    at the same time, the others wait for their turn.
+    '''
+
+    def __init__(self, key: str, tokenfile: Path, api: str = "api.vasttrafik.se/bin/rest.exe/v2", pool_size: int = 4, timeout: float = 10.0, cache: Optional[Cache] = None, concurrency: int = 10, limiter: Optional[RateLimiter] = None, retries: int = 2, backoff: float = 0.5, breaker: Optional[CircuitBreaker] = None) -> None:
+        self._sync = Vasttrafik(key, tokenfile, api, pool_size, timeout, cache, limiter=limiter, retries=retries, backoff=backoff, breaker=breaker)
+        self._pool = AsyncHTTPPool(max(pool_size, concurrency), timeout)
+        self.concurrency = concurrency
+        # Created in the running loop, before python 3.10 it is bound
+        # to the loop that is current when it is created
+        self._semaphore: Optional['asyncio.Semaphore'] = None
+        self.datetime_obj: Optional[datetime.datetime] = None
+
+    async def close(self) -> None:
+        await self._pool.close()
+        self._sync.transport.close()
+
+    async def _get_token(self) -> Token:
+        token = self._sync._tokens.current()
+        if token is not None:
+            return token
+        # Renewing is rare, so it is just done in a thread
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, self._sync._get_token)
+
+    async def _request(self, service, param, refresh=False):
+        return (await self._request_aged(service, param, refresh))[0]
+
+    @staticmethod
+    async def _blocking(f: Callable, *args):
+        '''
+        Runs in a thread the functions that use the sqlite cache, which
+        can wait for a lock.
+        '''
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+    async def _request_aged(self, service: str, param: str, refresh: bool = False) -> Tuple[Any, float]:
+        sync = self._sync
+        if sync.cache is not None:
+            cached = await self._blocking(sync._cached, service, param, refresh)
+            if cached is not None:
+                return cached
+
+        if not sync.breaker.allow():
+            return await self._blocking(sync._stale, service, param, Exception('The API is not responding, not trying for now'))
+        try:
+            resp = await self._attempts(service, param)
+        except Exception as e:
+            sync.breaker.failure()
+            return await self._blocking(sync._stale, service, param, e)
+        sync.breaker.success()
+        if sync.cache is not None:
+            return await self._blocking(sync._decode, service, param, resp), 0.0
+        return sync._decode(service, param, resp), 0.0
+
+    async def _attempts(self, service: str, param: str) -> Response:
+        '''
+        Same as Vasttrafik._attempts
+        '''
+        import asyncio
+        sync = self._sync
+        for attempt in range(sync.retries + 1):
+            if attempt:
+                await asyncio.sleep(sync._retry_delay(attempt))
+            if sync.limiter is not None:
+                await asyncio.sleep(sync.limiter.reserve())
+
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+            async with self._semaphore:
+                token = (await self._get_token()).access_token
+                try:
+                    resp = await self._pool.request('GET', sync._url(service, param), {'Authorization': 'Bearer ' + token})
+                except OSError:
+                    if attempt == sync.retries:
+                        raise
+                    continue
+            if resp.status not in RETRY_STATUS:
+                return resp
+        raise Exception(f'HTTP error {resp.status} {resp.reason}')
+
+    async def location(self, user_input, refresh=False) -> Stops:
+        '''Returns a list of Stop objects, completing from the user input'''
+        service, params = Vasttrafik._location_query(user_input)
+        return Vasttrafik._parse_stops(await self._request(service, params, refresh))
+
+    async def nearby(self, lat: float, lon: float, stops: int = 10, dist: Optional[int] = None, refresh: bool = False) -> Stops:
+        '''Returns the list of stops close to a certain location'''
+        service, params = Vasttrafik._nearby_query(lat, lon, stops, dist)
+        return Vasttrafik._parse_stops(await self._request(service, params, refresh))
+
+    async def board(self, id, direction=None, arrival=False, time_span=None, departures=2, datetime_obj=None, refresh=False) -> List[BoardItem]:
+        '''Returns an arrival/departure board for a given station, see Vasttrafik.board'''
+        service, params = Vasttrafik._board_query(id, direction, arrival, time_span, departures, datetime_obj)
+        reply, age = await self._request_aged(service, params, refresh)
+        servertime, trams = Vasttrafik._parse_board(reply, arrival)
+        if age:
+            servertime += datetime.timedelta(seconds=int(age))
+            trams = upcoming(servertime, trams)
+        self.datetime_obj = servertime
+        return trams
+
+    async def trip(self, originCoord=None, originId=None, originCoordName=None, destCoord=None, destId=None, destCoordName=None, viaId=None, datetime_obj=None, refresh=False) -> Trips:
+        '''Returns the trips between two places, see Vasttrafik.trip'''
+        service, params = Vasttrafik._trip_query(originCoord, originId, originCoordName, destCoord, destId, destCoordName, viaId, datetime_obj)
+        reply, age = await self._request_aged(service, params, refresh)
+        servertime, trips = Vasttrafik._parse_trip(reply)
+        if age:
+            servertime += datetime.timedelta(seconds=int(age))
+            trips = [i for i in trips if i.legs and i.departure >= servertime]
+        self.datetime_obj = servertime
+        return trips